@@ -0,0 +1,213 @@
+import asyncio
+import random
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from loguru import logger
+from tweepy import StreamResponse, StreamRule, Tweet
+from tweepy.asynchronous import AsyncStreamingClient
+
+from api.playlistter_bot import PlaylistterBot
+from models.campaign_registry import Campaign
+from models.reply_dispatcher import OUTCOME_ADDED, OUTCOME_ALREADY_IN_PLAYLIST, OUTCOME_ALREADY_SUBMITTED
+from models.reply_event_log import STAGE_ADDED, STAGE_FAILED, STAGE_PROCESSED
+from models.reply_ledger import STATUS_ADDED
+
+
+class AsyncPlaylistterEngine:
+    """Runs the stream -> lookup -> add -> reply pipeline as concurrent asyncio tasks instead of on worker threads.
+
+    The stream uses tweepy's `AsyncStreamingClient`. spotipy and pymongo have no async clients in this project,
+    so their calls are offloaded to threads. Every offloaded call is bounded by a per-service semaphore,
+    and replies from the same user to the same campaign are still processed one at a time, in order.
+    Reply tweets go through the bot's reply dispatcher.
+    Requires tweepy's `async` extra (aiohttp).
+    """
+
+    def __init__(self, playlistter: PlaylistterBot, twitter_concurrency: int, spotify_concurrency: int, mongo_concurrency: int,
+                 initial_backoff: float, max_backoff: float):
+        self.playlistter = playlistter
+        self.limits: Dict[str, asyncio.Semaphore] = {"twitter": asyncio.Semaphore(twitter_concurrency),
+                                                     "spotify": asyncio.Semaphore(spotify_concurrency),
+                                                     "mongo": asyncio.Semaphore(mongo_concurrency)}
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.rules: Dict[str, str] = {}
+        self.streaming_client = self.AsyncTwitterReplyWatcher(self)
+        self._backoff = initial_backoff
+        self._stream_task: Optional[asyncio.Task] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._user_locks: Dict[Tuple[str, str], List] = {}
+        self.playlistter.metrics.gauge("async_engine.in_flight", self.in_flight)
+
+    async def call(self, service: str, func: Callable, *args, **kwargs) -> Any:
+        """Run a blocking client call on a thread, waiting for a free slot of the service's concurrency limit"""
+        async with self.limits[service]:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    async def governed(self, endpoint: str, func: Callable, *args, **kwargs) -> Any:
+        """Run an async client call once the bot's rate governor has budget for it, timed like `PlaylistterBot.governed`"""
+        await asyncio.to_thread(self.playlistter.rate_governor.acquire, endpoint)
+        with self.playlistter.metrics.span(f"{endpoint.split('.')[0]}.{func.__name__}"):
+            return await func(*args, **kwargs)
+
+    def in_flight(self) -> int:
+        return len(self._tasks)
+
+    # STREAM METHODS
+    async def start_new_stream(self):
+        """Point the stream at every campaign's root tweet, connecting only if the stream isn't already running"""
+        rules = self.playlistter.campaigns.stream_rules()
+        if rules != self.rules:
+            logger.debug(f"will watch rules: {rules}")
+            await self.sync_rules(rules)
+            self.rules = rules
+
+        if self._stream_task is None or self._stream_task.done():
+            self._stream_task = asyncio.create_task(self._run_stream())
+
+    async def sync_rules(self, desired_rules: Dict[str, str]):
+        """Add and delete only the rules (value -> tag) that differ from the ones twitter already has"""
+        response = await self.governed("twitter.stream_rules", self.streaming_client.get_rules)
+        current_rules = {(rule.value, rule.tag): rule.id for rule in response.data or []}
+
+        stale_rule_ids = [rule_id for (value, tag), rule_id in current_rules.items() if desired_rules.get(value) != tag]
+        if stale_rule_ids:
+            await self.governed("twitter.stream_rules", self.streaming_client.delete_rules, stale_rule_ids)
+
+        missing_rules = [StreamRule(value, tag) for value, tag in desired_rules.items() if (value, tag) not in current_rules]
+        if missing_rules:
+            await self.governed("twitter.stream_rules", self.streaming_client.add_rules, missing_rules)
+
+    def kill_stream(self):
+        logger.debug("Killing stream")
+        if self._stream_task:
+            self._stream_task.cancel()
+        self.streaming_client.disconnect()
+
+    async def _run_stream(self):
+        while True:
+            logger.debug("Starting stream")
+            try:
+                await self.streaming_client.filter(tweet_fields="id,author_id,conversation_id,created_at,in_reply_to_user_id")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Stream crashed")
+
+            delay = random.uniform(0, self._backoff)
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            logger.warning(f"Stream disconnected, reconnecting in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+    # REPLY METHODS
+    def submit(self, campaign: Campaign, reply: Tweet):
+        task = asyncio.create_task(self.process_reply(campaign, reply))
+        self._tasks.add(task)
+        task.add_done_callback(self._on_task_done)
+
+    def _on_task_done(self, task: asyncio.Task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception():
+            logger.opt(exception=task.exception()).error("Failed to process reply")
+
+    async def process_reply(self, campaign: Campaign, reply: Tweet):
+        # Replies from the same user to the same campaign wait on each other so the one-song-per-day check stays correct
+        lock_key = (campaign.name, str(reply.author_id))
+        user_lock = self._user_locks.setdefault(lock_key, [asyncio.Lock(), 0])
+        user_lock[1] += 1
+        try:
+            async with user_lock[0]:
+                with self.playlistter.metrics.span("reply.process"):
+                    await self._process_reply(campaign, reply)
+        finally:
+            user_lock[1] -= 1
+            if not user_lock[1]:
+                del self._user_locks[lock_key]
+
+    async def _process_reply(self, campaign: Campaign, reply: Tweet):
+        playlistter = self.playlistter
+        song_proposal = playlistter.extract_song_proposal(reply)
+        message_args = {"playlist_url": campaign.playlist_url}
+
+        # Ensure this user hasn't already suggested a song for today, and take their daily slot if they haven't
+        if not await self.call("mongo", campaign.reply_ledger.claim, reply.author_id, reply.id, song_proposal):
+            logger.debug(f"Found duplicate reply to root tweet {campaign.root_tweet_id}: {reply.text}")
+            playlistter.metrics.inc("replies.already_submitted")
+            playlistter.mark_stage(reply, STAGE_PROCESSED, outcome=OUTCOME_ALREADY_SUBMITTED)
+            playlistter.reply_dispatcher.dispatch(reply, OUTCOME_ALREADY_SUBMITTED, campaign.name, message_args)
+            return
+
+        logger.debug(f"Found new reply to root tweet {campaign.root_tweet_id}: {reply.text}")
+        try:
+            song_uri = await self.call("spotify", playlistter.lookup_songs, song_proposal)
+            queued_song = playlistter.queue_song_for_playlist(campaign, song_uri)
+            if queued_song:
+                await self.call("mongo", campaign.reply_ledger.update, reply.author_id, reply.id, song_uri=song_uri)
+                playlistter.mark_stage(reply, STAGE_PROCESSED, song_uri=song_uri)
+                # Only confirm once the batch containing the song was written to the playlist
+                await asyncio.wrap_future(queued_song)
+        except Exception as e:
+            playlistter.metrics.inc("replies.add_failed")
+            playlistter.mark_stage(reply, STAGE_FAILED, error=repr(e))
+            await self.call("mongo", campaign.reply_ledger.release, reply.author_id, reply.id)
+            raise
+
+        if queued_song:
+            logger.debug(f"Added song {song_uri} to playlist")
+            playlistter.metrics.inc("replies.added")
+            playlistter.observe_since_created("reply.time_to_playlist", reply)
+            await self.call("mongo", campaign.reply_ledger.update, reply.author_id, reply.id, status=STATUS_ADDED)
+            playlistter.mark_stage(reply, STAGE_ADDED)
+            playlistter.reply_dispatcher.dispatch(reply, OUTCOME_ADDED, campaign.name, message_args)
+        else:  # Tell user that the song is already in the playlist, they're free to suggest something else
+            await self.call("mongo", campaign.reply_ledger.release, reply.author_id, reply.id)
+            playlistter.metrics.inc("replies.already_in_playlist")
+            playlistter.mark_stage(reply, STAGE_PROCESSED, outcome=OUTCOME_ALREADY_IN_PLAYLIST)
+            playlistter.reply_dispatcher.dispatch(reply, OUTCOME_ALREADY_IN_PLAYLIST, campaign.name, message_args)
+            logger.debug(f"Song {song_proposal} is already in the playlist, informed requesting user")
+
+    class AsyncTwitterReplyWatcher(AsyncStreamingClient):
+        def __init__(self, engine):
+            self.engine = engine
+            super().__init__(engine.playlistter.twitter_bearer_token, wait_on_rate_limit=True, max_retries=25)
+
+        async def on_connect(self):
+            logger.debug("Successfully connected to Twitter Stream")
+            self.engine.playlistter.metrics.inc("stream.connects")
+            self.engine._backoff = self.engine.initial_backoff
+
+        async def on_errors(self, errors):
+            logger.error(f"Error from Twitter Stream: {errors}")
+            self.engine.playlistter.metrics.inc("stream.errors")
+
+        async def on_request_error(self, status_code):
+            # The stream authenticates with the app bearer token, so a 401 here says nothing about the bot user's credentials
+            self.engine.playlistter.metrics.inc(f"stream.request_errors.{status_code}")
+            logger.error(f"Stream request error: {status_code}")
+
+        async def on_response(self, response: StreamResponse):
+            # Handled here rather than in `on_tweet`, since only the full response carries the rules (and so the campaign) it matched
+            if response.data is None:
+                return
+            reply = response.data
+            logger.debug(f"Received reply from Twitter: {reply}")
+            self.engine.playlistter.observe_since_created("stream.delivery_lag", reply)
+
+            campaign = self.engine.playlistter.campaigns.route(reply, response.matching_rules)
+            if campaign is None:
+                logger.warning(f"Reply {reply.id} doesn't belong to any campaign, ignoring it")
+                self.engine.playlistter.metrics.inc("stream.unrouted_tweets")
+            elif self.engine.playlistter.is_direct_reply(reply):  # Only reply to direct replies (aka have a single `@` in the tweet)
+                logger.debug(f"Direct reply to campaign {campaign.name} detected, {self.engine.in_flight()} replies in flight")
+                self.engine.playlistter.metrics.inc("stream.direct_replies")
+                # Logged before anything else happens to it, so it can be replayed if the bot dies mid-reply
+                await asyncio.to_thread(self.engine.playlistter.log_received, campaign, reply)
+                self.engine.submit(campaign, reply)
+            else:  # Not a direct reply
+                logger.debug(f"Captured tweet was not a direct reply")
+                self.engine.playlistter.metrics.inc("stream.ignored_tweets")
+
+        async def on_disconnect(self):
+            # `_run_stream` takes care of reconnecting, so just let the stream end
+            logger.debug("Disconnected from Twitter Stream")
+            self.engine.playlistter.metrics.inc("stream.disconnects")
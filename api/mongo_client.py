@@ -1,18 +1,66 @@
-import sys
 import urllib.parse
+from typing import Optional, Sequence
 
 from loguru import logger
-from pymongo import MongoClient
+from pymongo import ASCENDING, MongoClient
+from pymongo.database import Database
+from pymongo.errors import OperationFailure
+from pymongo.monitoring import CommandListener
 
-logger.add(sys.stderr, format="<lvl> {level} - {message}</lvl>",
-           filter=f"{__name__}",
-           level="DEBUG",
-           colorize=True,
-           backtrace=True,
-           diagnose=True,
-           catch=True)
+from util import config
 
+# Raised by `create_index` when an index with the same keys but different options (e.g. a changed TTL) already exists
+INDEX_OPTIONS_CONFLICT = 85
+LEGACY_REPLY_LEDGER_INDEX = "date_1_author_id_1"
 
-def login(username: str, password: str, hostname: str) -> MongoClient:
+
+def login(username: str, password: str, hostname: str, event_listeners: Optional[Sequence[CommandListener]] = None) -> MongoClient:
+    """Create the one pooled client shared by the scheduler's job store and the bot's collections"""
     connect_str = f"mongodb+srv://{urllib.parse.quote(username)}:{urllib.parse.quote(password)}@{hostname}".strip()
-    return MongoClient(connect_str)
\ No newline at end of file
+    write_concern = int(config.MONGO_WRITE_CONCERN) if config.MONGO_WRITE_CONCERN.isdigit() else config.MONGO_WRITE_CONCERN
+    return MongoClient(connect_str,
+                       appname="playlistter",
+                       maxPoolSize=config.MONGO_MAX_POOL_SIZE,
+                       minPoolSize=config.MONGO_MIN_POOL_SIZE,
+                       maxIdleTimeMS=int(config.MONGO_MAX_IDLE_SECONDS * 1000),
+                       serverSelectionTimeoutMS=int(config.MONGO_SERVER_SELECTION_TIMEOUT_SECONDS * 1000),
+                       connectTimeoutMS=int(config.MONGO_CONNECT_TIMEOUT_SECONDS * 1000),
+                       socketTimeoutMS=int(config.MONGO_SOCKET_TIMEOUT_SECONDS * 1000),
+                       w=write_concern,
+                       retryWrites=True,
+                       event_listeners=event_listeners)
+
+
+def get_database(client: MongoClient, name: str) -> Database:
+    return client[name]
+
+
+def ensure_indexes(db: Database, search_cache_ttl_seconds: int, failed_reply_ttl_seconds: int):
+    """Create every index the bot's collections rely on. Cheap to call when they already exist"""
+    # One suggestion per user per campaign per day, enforced across bot processes. Replaces the index from before campaigns existed
+    if LEGACY_REPLY_LEDGER_INDEX in db["reply_ledger"].index_information():
+        db["reply_ledger"].drop_index(LEGACY_REPLY_LEDGER_INDEX)
+    db["reply_ledger"].create_index([("campaign", ASCENDING), ("date", ASCENDING), ("author_id", ASCENDING)], unique=True)
+
+    # Leases of dead replicas disappear on their own, and replicas claim queued replies of their partitions oldest first
+    db["leases"].create_index("expires_at", expireAfterSeconds=0)
+    db["reply_queue"].create_index([("partition", ASCENDING), ("status", ASCENDING), ("seq", ASCENDING)])
+    # Replies that used up their attempts stay around for inspection for a while, only they have a `failed_at`
+    ensure_ttl_index(db, "reply_queue", "failed_at", failed_reply_ttl_seconds)
+
+    # Lets the alias admin tool drop every alias of a wrongly matched track
+    db["song_aliases"].create_index("uri")
+
+    # Cached searches expire on their own
+    ensure_ttl_index(db, "search_cache", "created_at", search_cache_ttl_seconds)
+
+
+def ensure_ttl_index(db: Database, collection: str, field: str, ttl_seconds: int):
+    """Create a TTL index on the field, or update its TTL if the index already exists with a different one"""
+    try:
+        db[collection].create_index(field, expireAfterSeconds=ttl_seconds)
+    except OperationFailure as e:
+        if e.code != INDEX_OPTIONS_CONFLICT:
+            raise
+        logger.info(f"Updating {collection} TTL to {ttl_seconds}s")
+        db.command("collMod", collection, index={"keyPattern": {field: 1}, "expireAfterSeconds": ttl_seconds})
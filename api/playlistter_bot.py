@@ -1,21 +1,48 @@
-import sys
-from typing import List
+import atexit
+import datetime
+import functools
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, Dict, Iterator, List, Optional, Union
 
 import tweepy
 from loguru import logger
+from pymongo.database import Database
 from spotipy import Spotify
-from tweepy import Tweet
+from tweepy import StreamResponse, Tweet
 from tweepy.models import Status
 
-from util import helpers
+from api import mongo_client
+from models.alias_index import AliasIndex
+from models.backfill_checkpoint import BackfillCheckpoint
+from models.bot_identity import BotIdentity
+from models.campaign_registry import Campaign, CampaignRegistry, DEFAULT_CAMPAIGN
+from models.cluster_coordinator import ClusterCoordinator
+from models.mongo_bulk_writer import MongoBulkWriter
+from models.playlist_add_buffer import PlaylistAddBuffer
+from models.playlist_index import PlaylistIndex
+from models.reply_dispatcher import ReplyDispatcher, OUTCOME_ADDED, OUTCOME_ALREADY_IN_PLAYLIST, OUTCOME_ALREADY_SUBMITTED
+from models.reply_event_log import ReplyEventLog, STAGE_ADDED, STAGE_FAILED, STAGE_PROCESSED, STAGE_QUEUED, STAGE_REPLIED
+from models.reply_ledger import ReplyLedger, STATUS_ADDED
+from models.reply_work_queue import ReplyWorkQueue
+from models.reply_worker_pool import ReplyWorkerPool
+from models.search_cache import SearchCache
+from models.stream_supervisor import StreamSupervisor
+from util import config, helpers, matching
+from util.metrics import Metrics
+from util.rate_governor import RateGovernor, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+
+# Replies and prompts are format strings, filled in with the campaign's `playlist_url` (and `theme` for the prompt)
+SONG_ADDED_REPLY = "I've added your song to the playlist! Find it here: {playlist_url}"
+SONG_ALREADY_IN_PLAYLIST_REPLY = "This song is already in the playlist! Feel free to choose a different one 🙂"
+ALREADY_SUBMITTED_REPLY = "Sorry but you've already submitted a song for today! Try again tomorrow"
+SONG_PROMPT = """~~ Good Day! ~~{theme}
 
-logger.add(sys.stderr, format="<lvl> {level} - {message}</lvl>",
-           filter=f"{__name__}",
-           level="DEBUG",
-           colorize=True,
-           backtrace=True,
-           diagnose=True,
-           catch=True)
+    Help build out the crowd-sourced playlist by directly replying to this tweet in the following format: song - artist
+
+    *The only catch is that you can only suggest one song per day!*
+
+    Playlist Link: {playlist_url}"""
 
 
 class PlaylistterBot:
@@ -28,8 +55,16 @@ class PlaylistterBot:
                  twitter_bearer_token: str,
                  spotify_client_id: str,
                  spotify_client_secret: str,
-                 spotify_perma_token: str,
-                 spotify_playlist_id: str):
+                 spotify_perma_token: Union[str, Callable[[], str]],
+                 spotify_playlist_id: str,
+                 mongo_db: Optional[Database] = None,
+                 rate_governor: Optional[RateGovernor] = None,
+                 metrics: Optional[Metrics] = None,
+                 event_log: Optional[ReplyEventLog] = None,
+                 campaigns: Optional[Dict[str, str]] = None,
+                 cluster_node_id: Optional[str] = None,
+                 threaded_engine: bool = True,
+                 bulk_writes: bool = True):
         # ------ TWITTER Vars ------
         logger.debug("Setting up twitter client")
         self.twitter_api_key = twitter_api_key
@@ -38,11 +73,21 @@ class PlaylistterBot:
         self.twitter_token_secret = twitter_token_secret
         self.twitter_bearer_token = twitter_bearer_token
 
-        logger.debug("logging in to twitter")
+        # Every outbound twitter and spotify call waits for budget here first
+        self.rate_governor = rate_governor or RateGovernor()
+        # Every outbound call is timed here, see `governed`
+        self.metrics = metrics or Metrics()
+        # Every direct reply and the stages it gets through are logged here first, see `replay_unfinished`
+        self.event_log = event_log
+        if self.event_log is not None:
+            atexit.register(self.event_log.close)
+
+        # Building the twitter clients doesn't touch the network, the credentials are only verified during `login`
         self.twitter_client = self.twitter_login()
-        self.last_tweet = self.get_last_tweet()
-        logger.debug(f"Logged in twitter user: {self.get_logged_in_twitter_user().screen_name}")
-        logger.info("Twitter login successful")
+        self.twitter_search_client = tweepy.Client(bearer_token=self.twitter_bearer_token, wait_on_rate_limit=True)
+        self.bot_identity = BotIdentity(self.twitter_client,
+                                        governed=functools.partial(self.governed, "twitter.verify_credentials", response_source=self.twitter_client))
+        self.last_tweet: Optional[List[Status]] = None
 
         # ------ SPOTIFY Vars ------
         logger.debug("Setting up spotify client")
@@ -50,183 +95,653 @@ class PlaylistterBot:
         self.spotify_client_secret = spotify_client_secret
         self.spotify_perma_token = spotify_perma_token
         self.spotify_playlist_id = spotify_playlist_id
+        self.spotify_client: Optional[Spotify] = None
+
+        # ------ CAMPAIGN Vars ------
+        # campaign name -> playlist id. The default campaign is the bot's original thread and playlist
+        self.campaign_playlists: Dict[str, str] = {DEFAULT_CAMPAIGN: spotify_playlist_id, **(campaigns or {})}
+        # Campaigns sharing a playlist share its index and add buffer too
+        self.playlist_indexes: Dict[str, PlaylistIndex] = {}
+        self.playlist_add_buffers: Dict[str, PlaylistAddBuffer] = {}
+
+        # ------ BOT STATE Vars ------
+        self.mongo_db = mongo_db
+        # Without bulk writes, every state write goes straight to mongo (e.g. for mongomock, which can't run pymongo's bulk ops)
+        self.bulk_writes = bulk_writes
+        self.mongo_writer: Optional[MongoBulkWriter] = None
+        self.reply_checkpoint: Optional[BackfillCheckpoint] = None
+        self.search_cache: Optional[SearchCache] = None
+        self.alias_index: Optional[AliasIndex] = None
+        self.campaigns = CampaignRegistry(collection=self.mongo_db["campaigns"] if self.mongo_db is not None else None)
+
+        # ------ CLUSTER Vars ------
+        # Only set when running as one of several replicas, see `start_cluster`
+        if cluster_node_id is not None and mongo_db is None:
+            raise ValueError("Cluster mode needs mongo to coordinate the replicas")
+        if cluster_node_id is not None and not threaded_engine:
+            raise ValueError("Cluster mode only supports the threaded engine")
+        self.cluster_node_id = cluster_node_id
+        self.cluster: Optional[ClusterCoordinator] = None
+        self.reply_queue: Optional[ReplyWorkQueue] = None
+
+        # ------ ENGINE Vars ------
+        # The stream supervisor and reply worker threads are only built for the threaded engine, the asyncio engine brings its own
+        self.threaded_engine = threaded_engine
+        self.stream_supervisor: Optional[StreamSupervisor] = None
+
+        self.startup_timings: Dict[str, float] = {}
+        self.login()
+
+        # Replies are sent in the background, once per user, campaign and outcome per day
+        self.reply_dispatcher = ReplyDispatcher(send=self.reply_to,
+                                                messages={OUTCOME_ADDED: (SONG_ADDED_REPLY, PRIORITY_NORMAL),
+                                                          OUTCOME_ALREADY_IN_PLAYLIST: (SONG_ALREADY_IN_PLAYLIST_REPLY, PRIORITY_LOW),
+                                                          OUTCOME_ALREADY_SUBMITTED: (ALREADY_SUBMITTED_REPLY, PRIORITY_LOW)},
+                                                rate_governor=self.rate_governor,
+                                                budget_endpoint="twitter.update_status",
+                                                num_senders=config.REPLY_SENDERS,
+                                                max_retries=config.REPLY_SEND_RETRIES,
+                                                max_delay_seconds=config.REPLY_LOW_PRIORITY_MAX_DELAY_SECONDS,
+                                                low_budget_watermark=config.REPLY_LOW_BUDGET_WATERMARK,
+                                                low_priority=PRIORITY_LOW,
+                                                on_finished=self._on_reply_finished,
+                                                # Rejected credentials are re-validated, so the next send uses a fresh login
+                                                on_auth_error=functools.partial(self.get_logged_in_twitter_user, refresh=True))
+        self.reply_dispatcher.start()
+
+        # A single stream serves every campaign, replies are routed by the tag of the rule they matched.
+        # The watcher also carries the reply pipeline `replay_unfinished` resumes, so it's built for either engine
+        self.streaming_client = self.TwitterReplyWatcher(self)
+        if self.threaded_engine:
+            self.stream_supervisor = StreamSupervisor(self.streaming_client,
+                                                      tweet_fields="id,author_id,conversation_id,created_at,in_reply_to_user_id",
+                                                      initial_backoff=config.STREAM_RECONNECT_BACKOFF_SECONDS,
+                                                      max_backoff=config.STREAM_RECONNECT_MAX_BACKOFF_SECONDS,
+                                                      governed=functools.partial(self.governed, "twitter.stream_rules"))
+
+        self.build_campaigns()
+        self.register_metrics()
+
+    def build_campaigns(self):
+        """Register every campaign with its own ledger and reply worker lane, on top of the shared clients, caches and playlist buffers"""
+        for playlist_id in set(self.campaign_playlists.values()):
+            # Accepted songs are written to the playlist in batches instead of one request per song
+            playlist_add_buffer = PlaylistAddBuffer(flush_items=functools.partial(self.flush_songs_to_playlist, playlist_id),
+                                                    max_items=config.PLAYLIST_BATCH_SIZE,
+                                                    max_wait_seconds=config.PLAYLIST_BATCH_WAIT_SECONDS)
+            playlist_add_buffer.start()
+            self.playlist_add_buffers[playlist_id] = playlist_add_buffer
+
+        for name, playlist_id in self.campaign_playlists.items():
+            # Keeps track of who already suggested a song to this campaign today
+            reply_ledger = ReplyLedger(collection=self.mongo_db["reply_ledger"] if self.mongo_db is not None else None,
+                                       writer=self.mongo_writer,
+                                       campaign=name)
+            campaign = Campaign(name, playlist_id, self.playlist_indexes[playlist_id], self.playlist_add_buffers[playlist_id], reply_ledger)
+
+            # Replies are looked up, added and answered off the streaming thread so slow API calls don't stall the stream.
+            # Every campaign has its own lane, so a busy thread can't hold up the others
+            if self.threaded_engine:
+                handler = self.process_queued_reply if self.reply_queue is not None else self.streaming_client.process_reply
+                campaign.reply_workers = ReplyWorkerPool(handler=functools.partial(handler, campaign),
+                                                         num_workers=config.REPLY_WORKERS,
+                                                         max_queue_size=config.REPLY_QUEUE_SIZE,
+                                                         put_timeout=config.REPLY_ENQUEUE_TIMEOUT_SECONDS)
+                campaign.reply_workers.start()
+            self.campaigns.add(campaign)
+
+        # Before campaigns existed, the root tweet was simply the bot's last tweet
+        default_campaign = self.campaigns.get(DEFAULT_CAMPAIGN)
+        if default_campaign.root_tweet_id is None and self.last_tweet:
+            root_tweet = self.last_tweet[0]
+            self.campaigns.set_root(default_campaign, root_tweet.id_str,
+                                    day=root_tweet.created_at.astimezone(helpers.EASTERN_TZ).date().isoformat())
+        logger.info(f"Running campaigns: {list(self.campaigns)}")
+
+    def register_metrics(self):
+        """Expose the counters the bot's components already keep as gauges"""
+        self.metrics.gauge("search_cache", self.search_cache.stats)
+        self.metrics.gauge("alias_index", self.alias_index.stats)
+        self.metrics.gauge("reply_dispatcher", self.reply_dispatcher.stats)
+        if self.stream_supervisor is not None:
+            self.metrics.gauge("stream.reconnects", lambda: self.stream_supervisor.reconnects)
+        self.metrics.gauge("rate_governor.waits", lambda: self.rate_governor.waits)
+        if self.mongo_writer is not None:
+            self.metrics.gauge("mongo_writer", self.mongo_writer.stats)
+        if self.cluster is not None:
+            self.metrics.gauge("cluster", self.cluster.stats)
+            self.metrics.gauge("reply_queue", self.reply_queue.stats)
+            self.metrics.gauge("reply_queue.depth", self.reply_queue.depth)
+
+        for campaign in self.campaigns:
+            if campaign.reply_workers is not None:
+                self.metrics.gauge(f"campaign.{campaign.name}.reply_workers", campaign.reply_workers.stats)
+        for playlist_id in self.playlist_indexes:
+            self.metrics.gauge(f"playlist.{playlist_id}.index_size", functools.partial(len, self.playlist_indexes[playlist_id]))
+            self.metrics.gauge(f"playlist.{playlist_id}.flushes", functools.partial(getattr, self.playlist_add_buffers[playlist_id], "flushes"))
+
+    def log_metrics_summary(self):
+        logger.info(f"Metrics summary:\n{self.metrics.summary()}")
+
+    def login(self):
+        """Run every login probe and startup load at once instead of one round-trip after another"""
+        with helpers.timed_phase("startup", self.startup_timings):
+            with ThreadPoolExecutor(max_workers=4, thread_name_prefix="startup") as executor:
+                probes = [executor.submit(self._login_phase, "twitter_last_tweet", self._load_last_tweet),
+                          executor.submit(self._login_phase, "twitter_credentials", self._verify_twitter_credentials),
+                          executor.submit(self._login_phase, "spotify", self._login_spotify),
+                          executor.submit(self._login_phase, "bot_state", self._load_bot_state)]
+                for probe in probes:
+                    probe.result()
+
+        logger.info("Startup timings: " + ", ".join(f"{phase}={seconds:.2f}s" for phase, seconds in self.startup_timings.items()))
+
+    def _login_phase(self, phase: str, func: Callable[[], None]):
+        with helpers.timed_phase(phase, self.startup_timings):
+            func()
+
+    def _load_last_tweet(self):
+        self.last_tweet = self.get_last_tweet()
 
+    def _verify_twitter_credentials(self):
+        logger.debug("logging in to twitter")
+        logger.debug(f"Logged in twitter user: {self.get_logged_in_twitter_user().screen_name}")
+        logger.info("Twitter login successful")
+
+    def _login_spotify(self):
         logger.debug("Logging in to spotify")
         self.spotify_client = self.spotify_login()
         logger.debug(f"Logged in spotify user: {self.get_logged_in_spotify_user()['id']}")
         logger.info("Spotify login successful")
 
-        self.streaming_client = self.TwitterReplyWatcher(self, last_tweet=self.last_tweet[0])
+        logger.debug("Indexing playlist tracks")
+        for playlist_id in set(self.campaign_playlists.values()):
+            playlist_index = PlaylistIndex(self.spotify_client, playlist_id,
+                                           collection=self.mongo_db["playlist_index"] if self.mongo_db is not None else None,
+                                           governed=functools.partial(self.governed, "spotify"))
+            with self.metrics.span("spotify.playlist_index_load"):
+                playlist_index.load()
+            self.playlist_indexes[playlist_id] = playlist_index
+
+    def reconcile_playlist_index(self):
+        for playlist_index in self.playlist_indexes.values():
+            with self.metrics.span("spotify.playlist_index_reconcile"):
+                playlist_index.reconcile()
+
+    def _load_bot_state(self):
+        if self.mongo_db is not None:
+            mongo_client.ensure_indexes(self.mongo_db, search_cache_ttl_seconds=config.SEARCH_CACHE_TTL_SECONDS,
+                                        failed_reply_ttl_seconds=config.WORK_QUEUE_FAILED_TTL_SECONDS)
+
+        if self.mongo_db is not None and self.bulk_writes:
+            # Checkpoint, cache and status writes don't need to block a reply, so they're sent in unordered batches
+            self.mongo_writer = MongoBulkWriter(max_ops=config.MONGO_BULK_BATCH_SIZE, max_wait_seconds=config.MONGO_BULK_WAIT_SECONDS)
+            self.mongo_writer.start()
+            atexit.register(self.mongo_writer.stop)
+
+        self.campaigns.load_roots()
+        self.reply_checkpoint = BackfillCheckpoint(collection=self.mongo_db["reply_checkpoints"] if self.mongo_db is not None else None,
+                                                   writer=self.mongo_writer)
+
+        self.search_cache = SearchCache(max_size=config.SEARCH_CACHE_SIZE,
+                                        ttl_seconds=config.SEARCH_CACHE_TTL_SECONDS,
+                                        collection=self.mongo_db["search_cache"] if self.mongo_db is not None else None,
+                                        writer=self.mongo_writer)
+
+        # Every resolved suggestion becomes an alias, so the same track written differently later needs no search at all
+        self.alias_index = AliasIndex(min_confidence=config.ALIAS_MIN_CONFIDENCE,
+                                      reload_seconds=config.ALIAS_RELOAD_SECONDS,
+                                      collection=self.mongo_db["song_aliases"] if self.mongo_db is not None else None,
+                                      writer=self.mongo_writer)
+        with self.metrics.span("mongo.alias_index_load"):
+            self.alias_index.load()
+        if self.mongo_db is not None:
+            self.alias_index.start()
+            atexit.register(self.alias_index.stop)
+
+        if self.cluster_node_id is not None:
+            self.cluster = ClusterCoordinator(self.mongo_db["leases"], self.cluster_node_id,
+                                              lease_seconds=config.CLUSTER_LEASE_SECONDS,
+                                              num_partitions=config.CLUSTER_PARTITIONS)
+            self.reply_queue = ReplyWorkQueue(self.mongo_db["reply_queue"], self.cluster_node_id,
+                                              num_partitions=config.CLUSTER_PARTITIONS,
+                                              claim_timeout_seconds=config.WORK_QUEUE_CLAIM_TIMEOUT_SECONDS,
+                                              max_attempts=config.WORK_QUEUE_MAX_ATTEMPTS,
+                                              poll_seconds=config.WORK_QUEUE_POLL_SECONDS)
+
+    def start_cluster(self, on_elected: Callable[[], None], on_demoted: Callable[[], None]):
+        """Join the other replicas: run `on_elected`/`on_demoted` as this replica gains or loses leadership, and process the
+        queued replies of the partitions this replica owns"""
+        self.cluster.on_elected, self.cluster.on_demoted = on_elected, on_demoted
+        self.cluster.start()
+        atexit.register(self.cluster.stop)
+        self.reply_queue.start(partitions=self.cluster.partitions, dispatch=self._dispatch_queued_reply, has_capacity=self._has_reply_capacity)
+        atexit.register(self.reply_queue.stop)
+        logger.info(f"Joined cluster as {self.cluster_node_id}, leader: {self.cluster.is_leader}, partitions: {sorted(self.cluster.partitions())}")
+
+    def submit_reply(self, campaign: Campaign, reply: Tweet):
+        """Hand a direct reply off for processing: to the replica owning its partition in cluster mode, to a local worker otherwise"""
+        if self.reply_queue is not None:
+            with self.metrics.span("reply_queue.enqueue"):
+                self.reply_queue.enqueue(campaign.name, reply)
+            self.mark_stage(reply, STAGE_QUEUED)
+            return
+        # Hand off to the worker that owns this user so their replies are still processed in order
+        with self.metrics.span("reply_workers.submit"):
+            campaign.reply_workers.submit(reply.author_id, reply)
+        logger.debug(f"Queued reply {reply.id}, reply queue stats: {campaign.reply_workers.stats()}")
+
+    def log_received(self, campaign: Campaign, reply: Tweet):
+        if self.event_log is not None:
+            with self.metrics.span("event_log.append"):
+                self.event_log.received(campaign.name, reply)
+
+    def mark_stage(self, reply: Tweet, stage: str, **fields):
+        if self.event_log is not None:
+            self.event_log.mark(reply.id, stage, **fields)
+
+    def _on_reply_finished(self, reply: Tweet, outcome: str):
+        self.mark_stage(reply, STAGE_REPLIED, outcome=outcome)
+
+    def replay_unfinished(self, submit: Optional[Callable[[Campaign, Tweet], None]] = None) -> int:
+        """Resume every reply the event log has no final marker for, e.g. because the bot died mid-reply. Each one picks up after the
+        last stage it finished, and the ledger recognizes the claims they made before, so replaying twice is harmless.
+        Replies that have to go through the whole pipeline again are handed to `submit`, `submit_reply` by default"""
+        if self.event_log is None:
+            return 0
+        self.event_log.prune()
+        entries = self.event_log.unfinished(days=config.REPLY_LOG_REPLAY_DAYS)
+        for entry in entries:
+            reply = Tweet(entry["tweet"])
+            try:
+                campaign = self.campaigns.get(entry["campaign"])
+            except KeyError:
+                logger.warning(f"Can't replay reply {reply.id}, campaign {entry['campaign']} no longer exists")
+                self.mark_stage(reply, STAGE_FAILED, error="unknown campaign")
+                continue
+            self.streaming_client.resume_reply(campaign, reply, entry["day"], entry["stages"], submit or self.submit_reply)
+        logger.info(f"Replayed {len(entries)} unfinished replies from the reply log")
+        return len(entries)
+
+    def process_queued_reply(self, campaign: Campaign, reply: Tweet):
+        """Process a reply claimed from the work queue, then take it off the queue or hand it back if it failed.
+        A reply whose song was queued for the playlist stays claimed until the song is written, so if this replica dies before
+        that, the reply's claim times out and another replica picks it up"""
+        try:
+            queued_song = self.streaming_client.process_reply(campaign, reply)
+        except Exception:
+            self.reply_queue.retry(reply.id)
+            raise
+        if queued_song is None:
+            self.reply_queue.complete(reply.id)
+        else:
+            queued_song.add_done_callback(lambda future: self._on_queued_song_added(reply, future))
+
+    # noinspection PyBroadException
+    def _on_queued_song_added(self, reply: Tweet, future: Future):
+        # Runs as a future callback, whose exceptions only reach stdlib logging, so report them here
+        try:
+            if future.exception():
+                self.reply_queue.retry(reply.id)
+            else:
+                self.reply_queue.complete(reply.id)
+        except Exception:
+            logger.exception(f"Failed to settle queued reply {reply.id}, its claim will time out")
+
+    def _dispatch_queued_reply(self, doc: dict) -> bool:
+        # Claims come out oldest first, and the local worker that owns the user keeps them in that order
+        try:
+            campaign = self.campaigns.get(doc["campaign"])
+        except KeyError:
+            logger.error(f"Queued reply {doc['_id']} belongs to unknown campaign {doc['campaign']}, are all replicas configured alike?")
+            # Not a matter of room, so it counts as a failed attempt
+            self.reply_queue.retry(doc["_id"])
+            return True
+        reply = Tweet(doc["tweet"])
+        return campaign.reply_workers.submit(reply.author_id, reply)
+
+    def _has_reply_capacity(self) -> bool:
+        return sum(campaign.reply_workers.queue_depth() for campaign in self.campaigns) < config.REPLY_QUEUE_SIZE
 
     def twitter_login(self) -> tweepy.API:
         auth: tweepy.OAuth1UserHandler = tweepy.OAuthHandler(consumer_key=self.twitter_api_key, consumer_secret=self.twitter_api_secret)
         auth.set_access_token(key=self.twitter_token, secret=self.twitter_token_secret)
-        return tweepy.API(auth)
+        return self.TwitterAPI(auth)
 
     def spotify_login(self) -> Spotify:
-        sp_client = Spotify(auth=self.spotify_perma_token, requests_timeout=15, retries=5, status_retries=7, backoff_factor=0.3)
+        # The perma token can be handed over as a callable so the (slow) token exchange only happens during login
+        perma_token = self.spotify_perma_token() if callable(self.spotify_perma_token) else self.spotify_perma_token
+        sp_client = Spotify(auth=perma_token, requests_timeout=15, retries=5, status_retries=7, backoff_factor=0.3)
         return sp_client
 
+    def governed(self, endpoint: str, func: Callable, priority: int = PRIORITY_NORMAL, response_source: Optional[tweepy.API] = None):
+        """Wrap a client call so it waits for rate governor budget first. If `response_source` is given, the rate-limit headers of
+        the call's own response are fed back into the governor (see `TwitterAPI`). Both the wait and the call itself are timed"""
+        span = f"{endpoint.split('.')[0]}.{func.__name__}"
+
+        @functools.wraps(func)
+        def call(*args, **kwargs):
+            with self.metrics.span(f"rate_governor.{endpoint}"):
+                self.rate_governor.acquire(endpoint, priority)
+            if response_source is not None:
+                # So a call that fails before its request doesn't pass on the headers of this thread's previous call
+                response_source.last_response = None
+            try:
+                with self.metrics.span(span):
+                    return func(*args, **kwargs)
+            finally:
+                if response_source is not None:
+                    self.rate_governor.update_from_headers(endpoint, getattr(getattr(response_source, "last_response", None), "headers", None))
+
+        return call
+
     # TWITTER METHODS
-    def get_logged_in_twitter_user(self) -> tweepy.models.User:
-        """Used to both get the logged-in user object and validate the credentials"""
-        return self.twitter_client.verify_credentials()
+    def get_logged_in_twitter_user(self, refresh: bool = False) -> tweepy.models.User:
+        """Used to both get the logged-in user object and validate the credentials. The user is cached after the first call"""
+        return self.bot_identity.refresh() if refresh else self.bot_identity.user
 
     def get_last_tweet(self) -> List[Status]:
         """Return last tweet from logged-in user"""
-        return self.twitter_client.user_timeline(count=1, exclude_replies=True, include_rts=False) or None
+        user_timeline = self.governed("twitter.user_timeline", self.twitter_client.user_timeline, response_source=self.twitter_client)
+        return user_timeline(count=1, exclude_replies=True, include_rts=False) or None
+
+    def get_previous_replies_to_tweet(self, root_tweet_id: str) -> Iterator[Tweet]:
+        """Yield direct replies to the root tweet that haven't been seen yet, newest first.
+
+        Resumes from the stored checkpoint with `since_id`, so a restart only pages through replies that arrived since then.
+        The checkpoint is only advanced here, once every page was read, so an interrupted backfill is retried from the same point.
+        The live stream never advances it: its workers finish out of order, and a stream gap must stay visible to the next backfill.
+        """
+        since_id = self.reply_checkpoint.get(root_tweet_id)
+        newest_id = None
 
-    def get_previous_replies_to_tweet(self) -> List[Status]:
-        replies = []
         # Since there is no way to directly grab the replies to a tweet, we need to use the search API
-        bot_user = self.get_logged_in_twitter_user().screen_name
-        for tweet in tweepy.Cursor(self.twitter_client.search_tweets, q=f"to:{bot_user}", result_type="recent").items(500):
-            if hasattr(tweet, "in_reply_to_status_id_str") and tweet.in_reply_to_status_id_str == self.last_tweet[0].id_str:
-                replies.append(tweet)
-        return replies
+        paginator = tweepy.Paginator(self.governed("twitter.search", self.twitter_search_client.search_recent_tweets),
+                                     query=f"conversation_id:{root_tweet_id} is:reply",
+                                     since_id=since_id,
+                                     tweet_fields=["author_id", "conversation_id", "created_at", "referenced_tweets"],
+                                     max_results=100)
+        for tweet in paginator.flatten():
+            newest_id = newest_id or tweet.id
+
+            # Only keep direct replies to the root tweet, not replies to other replies in the thread
+            if any(ref.type == "replied_to" and ref.id == int(root_tweet_id) for ref in tweet.referenced_tweets or []):
+                yield tweet
+
+        if newest_id:
+            self.reply_checkpoint.advance(root_tweet_id, newest_id)
 
     # @staticmethod
     # def register_tweet_reply(tweet: Status):
     #     logger.debug(f"Registering reply {tweet.id_str}")
     #     helpers.USER_REPLIES[tweet.author_id] = tweet.id_str
 
-    def daily_prompt_for_songs(self):
-        """Invites everyone to submit a song for the day"""
-        logger.info("Prompting for songs")
-        song_prompt = f"""~~ Good Day! ~~
+    def daily_prompt_for_songs(self, campaign: Campaign) -> Status:
+        """Invites everyone to submit a song to the campaign for the day. The prompt becomes the campaign's new root tweet"""
+        logger.info(f"Prompting for songs for campaign {campaign.name}")
+        song_prompt = SONG_PROMPT.format(theme="" if campaign.name == DEFAULT_CAMPAIGN else f"\n\n    Today's theme: {campaign.name}",
+                                         playlist_url=campaign.playlist_url)
+        root_tweet = self.governed("twitter.update_status", self.twitter_client.update_status, PRIORITY_HIGH, self.twitter_client)(song_prompt)
+        self.campaigns.set_root(campaign, root_tweet.id)
+        return root_tweet
 
-    Help build out the crowd-sourced playlist by directly replying to this tweet in the following format: song - artist
+    def reply_to(self, reply: Tweet, message: str, priority: int = PRIORITY_NORMAL):
+        update_status = self.governed("twitter.update_status", self.twitter_client.update_status, priority, self.twitter_client)
+        update_status(status=message, in_reply_to_status_id=reply.id, auto_populate_reply_metadata=True)
 
-    *The only catch is that you can only suggest one song per day!*
-
-    Playlist Link: https://open.spotify.com/playlist/7sMcyP8zJ8Fr1WkZ27XL7Y?si=6213fe219e644fa5"""
-        self.twitter_client.update_status(song_prompt)
+    def extract_song_proposal(self, reply: Tweet) -> str:
+        return reply.text.replace(f"@{self.bot_identity.screen_name}", "").strip()
 
     def is_direct_reply(self, tweet: Tweet) -> bool:
-        return tweet.author_id != self.get_logged_in_twitter_user().id and tweet.text.count("@") == 1
+        return tweet.author_id != self.bot_identity.user_id and tweet.text.count("@") == 1
 
-    def start_new_stream(self, last_tweet: Status):
-        logger.debug(f"will watch last tweet: {last_tweet.id_str}")
+    def observe_since_created(self, name: str, tweet: Tweet):
+        """Record how long ago the tweet was posted, e.g. to see how far behind the stream or the reply pipeline is"""
+        if tweet.created_at:
+            self.metrics.observe(name, (datetime.datetime.now(tz=datetime.timezone.utc) - tweet.created_at).total_seconds())
 
+    def start_new_stream(self):
+        """Point the stream at every campaign's root tweet, (re)connecting only if the stream isn't already running"""
         # Need to subclass tweepy.StreamingClient to be able to customize stream functionalities
-        # technically `in_reply_to_status_id` is not listed in the documentation officially, but it exists
-        # https://developer.twitter.com/en/blog/product-news/2022/twitter-api-v2-filtered-stream
         # https://docs.tweepy.org/en/stable/streamingclient.html#streamingclient
-        self.streaming_client.add_rules(tweepy.StreamRule(f"in_reply_to_status_id:{last_tweet.id_str}"))
-
-        logger.debug("Starting stream")
-        # Ensure we get these fields in the response and start the stream
-        self.streaming_client.filter(tweet_fields="id,author_id,conversation_id,created_at,in_reply_to_user_id")
+        self.stream_supervisor.ensure(self.campaigns.stream_rules())
 
     def kill_stream(self):
         logger.debug("Killing stream")
-        self.streaming_client.disconnect()
+        self.stream_supervisor.stop()
 
     # SPOTIFY METHODS
     def get_logged_in_spotify_user(self):
-        user = self.spotify_client.me()
+        user = self.governed("spotify", self.spotify_client.me)()
         return user
 
-    def add_song_to_playlist(self, song: str) -> bool:
-        # Get playlist object
-        playlist = self.spotify_client.playlist(self.spotify_playlist_id)
-        playlist_songs = [uri["track"]["uri"] for uri in playlist["tracks"]["items"]]
-
-        # Only add song if it is not already in the playlist
-        if song not in playlist_songs:
-            ret = self.spotify_client.playlist_add_items(playlist_id=self.spotify_playlist_id, items=[song])
-            logger.debug(f"Added new song to playlist")
-        else:
+    def queue_song_for_playlist(self, campaign: Campaign, song: str) -> Optional[Future]:
+        """Buffer a song for the campaign playlist's next write. Returns a future that resolves once the song is actually in the
+        playlist, or None if the song is already in (or on its way to) the playlist"""
+        # Only add song if it is not already in the playlist (checked against the local index instead of refetching the playlist).
+        # Replicas don't see each other's buffers, so in cluster mode the song is also reserved in the shared index
+        if song in campaign.playlist_index or (self.cluster is not None and not campaign.playlist_index.reserve(song)):
             logger.debug(f"Song is already found in playlist")
-            ret = False
-        return ret
+            return None
+
+        future = campaign.playlist_add_buffer.submit(song)
+        if future is None:
+            logger.debug(f"Song is already waiting to be added to playlist")
+        return future
+
+    def add_song_to_playlist(self, campaign: Campaign, song: str) -> bool:
+        future = self.queue_song_for_playlist(campaign, song)
+        return future.result() if future else False
+
+    def flush_songs_to_playlist(self, playlist_id: str, songs: List[str]):
+        # Playlist writes get the high priority lane so they still go through when replies have used up most of the budget
+        try:
+            ret = self.governed("spotify", self.spotify_client.playlist_add_items, PRIORITY_HIGH)(playlist_id=playlist_id, items=songs)
+        except Exception:
+            if self.cluster is not None:
+                self.playlist_indexes[playlist_id].unreserve(songs)
+            raise
+        self.playlist_indexes[playlist_id].add(songs, snapshot_id=ret.get("snapshot_id") if ret else None)
+        logger.debug(f"Added {len(songs)} new songs to playlist {playlist_id}")
 
     def lookup_songs(self, comment: str) -> str:
-        # Split song proposal into song and artist
-        song_proposal = comment.split("-")
+        # Known tracks resolve from memory. Checked before the cache too, so a corrected alias wins over a stale cached search
+        alias_uri = self.alias_index.get(comment)
+        if alias_uri:
+            logger.debug(f"Alias hit for: {comment} ({self.alias_index.stats()})")
+            return alias_uri
+
+        # Popular songs get suggested over and over, so check the cache before searching spotify
+        with self.metrics.span("search_cache.get"):
+            cached_uri = self.search_cache.get(comment)
+        if cached_uri:
+            logger.debug(f"Search cache hit for: {comment} ({self.search_cache.stats()})")
+            return cached_uri
+
+        # Lookup song with Spotify API and score every result against the suggestion (in either song/artist order)
+        search = self.governed("spotify", self.spotify_client.search)
+        song_queries = search(q=helpers.normalize_query(comment), type="track", limit=30)
+        ranked_songs = matching.rank_tracks(comment, song_queries.get("tracks", {}).get("items", []))
+
+        # Only spend a second search on a structured `track: artist:` query when the first pass isn't confident
+        if not ranked_songs or ranked_songs[0][0] < matching.CONFIDENCE_THRESHOLD:
+            logger.debug(f"Low confidence match for: {comment}, retrying with a structured query")
+            song_queries = search(q=matching.structured_query(comment), type="track", limit=30)
+            ranked_songs = sorted(ranked_songs + matching.rank_tracks(comment, song_queries.get("tracks", {}).get("items", [])),
+                                  key=lambda scored: scored[0], reverse=True)
+
+        if not ranked_songs:
+            raise LookupError(f"No spotify tracks found for: {comment}")
+        score, song_details = ranked_songs[0]
+        logger.debug(f"Best match scored {score:.2f}")
 
-        # Lookup song with Spotify API and get the Spotify ID
-        song_queries = self.spotify_client.search(q=song_proposal, type="track", limit=30)
-        song_queries = song_queries.get("tracks", {}).get("items", [])
+        logger.debug(f"Found song: {song_details['name']} - {song_details['artists'][0]['name']}")
+        self.search_cache.set(comment, song_details["uri"])
+        if score >= matching.CONFIDENCE_THRESHOLD:
+            self.alias_index.learn(comment, song_details["uri"], score)
+        return song_details["uri"]
 
-        # Naively match the song and artist to the first result
-        song_details = song_queries[0]
+    class TwitterAPI(tweepy.API):
+        """`tweepy.API` that keeps `last_response` per thread, so concurrent callers each read the rate-limit headers of their own call"""
 
-        # I disabled this block because the naive approach somehow yields better results. I think spotify already optimizes their search
-        # results so I don't need to optimize it myself
+        def __init__(self, *args, **kwargs):
+            self._local = threading.local()
+            super().__init__(*args, **kwargs)
 
-        # Extract all artists from the search results artist_list = [] for song in
-        #  song_queries: for artist in song["artists"]: artist_list.append(artist["name"])
-        #
-        # # Do a fuzzy match to find the best match amongst results
-        # best_match = process.extractOne(artist["name"], artist_list, scorer=fuzz.token_set_ratio)
+        @property
+        def last_response(self):
+            return getattr(self._local, "last_response", None)
 
-        # Try to naively name-match the artist name provided to the track name
-        for track in song_queries:
-            for artist in track["artists"]:
-                if artist["name"].casefold() == song_details["artists"][0]["name"].casefold():
-                    song_details = track
-                    break
-
-        logger.debug(f"Found song: {song_details['name']} - {song_details['artists'][0]['name']}")
-        return song_details["uri"]
+        @last_response.setter
+        def last_response(self, response):
+            self._local.last_response = response
 
     class TwitterReplyWatcher(tweepy.StreamingClient):
-        def __init__(self, playlistter_bot, last_tweet: Status):
+        def __init__(self, playlistter_bot):
             self.playlistter = playlistter_bot
-            self.last_tweet: Status = last_tweet
             self.is_direct_reply = self.playlistter.is_direct_reply  # steal func from parent class
             super().__init__(playlistter_bot.twitter_bearer_token, wait_on_rate_limit=True, max_retries=25)
 
         def on_connect(self):
             logger.debug("Successfully connected to Twitter Stream")
+            self.playlistter.metrics.inc("stream.connects")
+            self.playlistter.stream_supervisor.on_connected()
             return super().on_connect()
 
         def on_errors(self, errors):
             logger.error(f"Error from Twitter Stream: {errors}")
+            self.playlistter.metrics.inc("stream.errors")
             return super().on_errors(errors)
 
-        def on_tweet(self, reply: Tweet):
-            logger.debug(f"Received reply from Twitter: {reply}")
-
-            if self.is_direct_reply(reply):  # Only reply to direct replies (aka have a single `@` in the tweet)
-                logger.debug(f"Direct reply detected")
-                # Ensure this user hasn't already suggested a song for today
-                if reply.author_id not in helpers.USER_REPLIES:
-                    logger.debug(f"Found new reply to root tweet {self.last_tweet.id}: {reply.text}")
-                    song_proposal = reply.text.replace(f"@{self.last_tweet.author.screen_name}", "").strip()
+        def on_request_error(self, status_code):
+            # The stream authenticates with the app bearer token, so a 401 here says nothing about the bot user's credentials
+            self.playlistter.metrics.inc(f"stream.request_errors.{status_code}")
+            return super().on_request_error(status_code)
 
+        def on_response(self, response: StreamResponse):
+            # Handled here rather than in `on_tweet`, since only the full response carries the rules (and so the campaign) it matched
+            if response.data is None:
+                return
+            reply = response.data
+            logger.debug(f"Received reply from Twitter: {reply}")
+            self.playlistter.observe_since_created("stream.delivery_lag", reply)
+
+            campaign = self.playlistter.campaigns.route(reply, response.matching_rules)
+            if campaign is None:
+                logger.warning(f"Reply {reply.id} doesn't belong to any campaign, ignoring it")
+                self.playlistter.metrics.inc("stream.unrouted_tweets")
+            elif self.is_direct_reply(reply):  # Only reply to direct replies (aka have a single `@` in the tweet)
+                logger.debug(f"Direct reply to campaign {campaign.name} detected")
+                self.playlistter.metrics.inc("stream.direct_replies")
+                # Logged before anything else happens to it, so it can be replayed if the bot dies mid-reply
+                self.playlistter.log_received(campaign, reply)
+                self.playlistter.submit_reply(campaign, reply)
+            else:  # Not a direct reply
+                logger.debug(f"Captured tweet was not a direct reply")
+                self.playlistter.metrics.inc("stream.ignored_tweets")
+
+        def process_reply(self, campaign: Campaign, reply: Tweet) -> Optional[Future]:
+            """Look up the suggested song, add it to the campaign's playlist and respond to the user. Runs on a reply worker thread.
+            Returns the future of the song's playlist write, if the song was queued for the playlist"""
+            try:
+                with self.playlistter.metrics.span("reply.process"):
+                    return self._process_reply(campaign, reply)
+            except Exception as e:
+                self.playlistter.mark_stage(reply, STAGE_FAILED, error=repr(e))
+                raise
+
+        def _process_reply(self, campaign: Campaign, reply: Tweet) -> Optional[Future]:
+            song_proposal = self.playlistter.extract_song_proposal(reply)
+            message_args = {"playlist_url": campaign.playlist_url}
+
+            # Ensure this user hasn't already suggested a song for today, and take their daily slot if they haven't
+            if campaign.reply_ledger.claim(reply.author_id, reply.id, song_proposal):
+                logger.debug(f"Found new reply to root tweet {campaign.root_tweet_id}: {reply.text}")
+                try:
                     # lookup and add song to playlist
                     logger.debug(f"Looking up song: {song_proposal}")
                     song_uri = self.playlistter.lookup_songs(song_proposal)
-                    added_to_playlist = self.playlistter.add_song_to_playlist(song_uri)
-
-                    # Verify song was added to playlist and reply to user if it wasn't
-                    if added_to_playlist:
-                        logger.debug(f"Added song {song_uri} to playlist")
-                        helpers.USER_REPLIES[reply.author_id] = song_proposal
-                        self.playlistter.twitter_client.update_status(
-                            status="I've added your song to the playlist! Find it here: https://open.spotify.com/playlist/7sMcyP8zJ8Fr1WkZ27XL7Y?si=5164424d3fc04102",
-                            in_reply_to_status_id=reply.id,
-                            auto_populate_reply_metadata=True)
-                    else:  # Tell user that the song is already in the playlist
-                        self.playlistter.twitter_client.update_status(
-                            status="This song is already in the playlist! Feel free to choose a different one 🙂",
-                            in_reply_to_status_id=reply.id,
-                            auto_populate_reply_metadata=True)
-                        logger.debug(f"Song {song_proposal} is already in the playlist, informed requesting user")
-                else:  # User has already suggested a song for today
-                    logger.debug(f"Found duplicate reply to root tweet {self.last_tweet.id_str}: {reply.text}")
-                    self.playlistter.twitter_client.update_status(
-                        status="Sorry but you've already submitted a song for today! Try again tomorrow",
-                        in_reply_to_status_id=reply.id,
-                        auto_populate_reply_metadata=True)
-            else:  # Not a direct reply
-                logger.debug(f"Captured tweet was not a direct reply")
+                    queued_song = self.playlistter.queue_song_for_playlist(campaign, song_uri)
+                except Exception:
+                    campaign.reply_ledger.release(reply.author_id, reply.id)
+                    raise
+
+                # Confirm once the batch containing the song is written, otherwise tell the user it's already in the playlist
+                if queued_song:
+                    campaign.reply_ledger.update(reply.author_id, reply.id, song_uri=song_uri)
+                    self.playlistter.mark_stage(reply, STAGE_PROCESSED, song_uri=song_uri)
+                    queued_song.add_done_callback(lambda future: self.on_song_added(campaign, reply, song_uri, future))
+                    return queued_song
+                else:  # Tell user that the song is already in the playlist, they're free to suggest something else
+                    campaign.reply_ledger.release(reply.author_id, reply.id)
+                    self.playlistter.metrics.inc("replies.already_in_playlist")
+                    self.playlistter.mark_stage(reply, STAGE_PROCESSED, outcome=OUTCOME_ALREADY_IN_PLAYLIST)
+                    self.playlistter.reply_dispatcher.dispatch(reply, OUTCOME_ALREADY_IN_PLAYLIST, campaign.name, message_args)
+                    logger.debug(f"Song {song_proposal} is already in the playlist, informed requesting user")
+            else:  # User has already suggested a song for today
+                logger.debug(f"Found duplicate reply to root tweet {campaign.root_tweet_id}: {reply.text}")
+                self.playlistter.metrics.inc("replies.already_submitted")
+                self.playlistter.mark_stage(reply, STAGE_PROCESSED, outcome=OUTCOME_ALREADY_SUBMITTED)
+                self.playlistter.reply_dispatcher.dispatch(reply, OUTCOME_ALREADY_SUBMITTED, campaign.name, message_args)
+
+        # noinspection PyBroadException
+        def on_song_added(self, campaign: Campaign, reply: Tweet, song_uri: str, future: Future):
+            """Release the confirmation reply once the song's batch was written to the playlist"""
+            # Runs as a future callback, whose exceptions only reach stdlib logging, so report them here
+            try:
+                self._on_song_added(campaign, reply, song_uri, future)
+            except Exception:
+                self.playlistter.metrics.inc("replies.confirm_failed")
+                logger.exception(f"Failed to confirm song {song_uri} for reply {reply.id}")
+
+        def _on_song_added(self, campaign: Campaign, reply: Tweet, song_uri: str, future: Future):
+            if future.exception():
+                logger.error(f"Failed to add song {song_uri} to playlist, freeing up {reply.author_id}'s daily suggestion")
+                self.playlistter.metrics.inc("replies.add_failed")
+                self.playlistter.mark_stage(reply, STAGE_FAILED, error=repr(future.exception()))
+                campaign.reply_ledger.release(reply.author_id, reply.id)
+                return
+
+            logger.debug(f"Added song {song_uri} to playlist")
+            self.playlistter.metrics.inc("replies.added")
+            self.playlistter.observe_since_created("reply.time_to_playlist", reply)
+            campaign.reply_ledger.update(reply.author_id, reply.id, status=STATUS_ADDED)
+            self.playlistter.mark_stage(reply, STAGE_ADDED)
+            self.playlistter.reply_dispatcher.dispatch(reply, OUTCOME_ADDED, campaign.name, {"playlist_url": campaign.playlist_url})
+
+        def resume_reply(self, campaign: Campaign, reply: Tweet, day: str, stages: Dict[str, dict],
+                         submit: Callable[[Campaign, Tweet], None]):
+            """Pick a reply from the event log, received on the bot `day`, back up after the last stage it finished"""
+            # The ledger only holds today's slots, so an earlier day's reply must not claim (or be matched against) one of them
+            is_today = day == helpers.current_day()
+            processed = stages.get(STAGE_PROCESSED)
+            ledger_entry = campaign.reply_ledger.get(reply.author_id) if is_today else None
+            if processed is None and ledger_entry and ledger_entry.get("reply_id") == str(reply.id) and ledger_entry.get("song_uri"):
+                # Stage markers aren't fsynced, but the ledger shows the song was already looked up
+                processed = {"song_uri": ledger_entry["song_uri"]}
+
+            if STAGE_ADDED in stages:  # Only the confirmation is missing
+                self.playlistter.reply_dispatcher.dispatch(reply, OUTCOME_ADDED, campaign.name, {"playlist_url": campaign.playlist_url})
+            elif processed is None and not is_today:  # Its day is over, so it can't take a suggestion slot anymore
+                logger.warning(f"Not replaying reply {reply.id} from {day}, it never got past the lookup")
+                self.playlistter.mark_stage(reply, STAGE_FAILED, error="expired")
+            elif processed is None:  # Never got past the lookup, so run it through the whole pipeline again
+                submit(campaign, reply)
+            elif processed.get("song_uri"):  # The song was waiting in the add buffer, unless it made it to the playlist already
+                song_uri = processed["song_uri"]
+                future = campaign.playlist_add_buffer.submit(song_uri) if song_uri not in campaign.playlist_index else None
+                if future is None:
+                    future = Future()
+                    future.set_result(None)
+                future.add_done_callback(lambda done: self.on_song_added(campaign, reply, song_uri, done))
+            else:  # Only the reply about the outcome is missing
+                self.playlistter.reply_dispatcher.dispatch(reply, processed["outcome"], campaign.name, {"playlist_url": campaign.playlist_url})
 
         def on_disconnect(self):
-            logger.debug("Forced disconnection from Twitter Stream. Killing bot")
-            sys.exit(1)
+            # The stream supervisor takes care of reconnecting, so just let the stream end
+            logger.debug("Disconnected from Twitter Stream")
+            self.playlistter.metrics.inc("stream.disconnects")
+            return super().on_disconnect()
 
         def on_closed(self, response):
             logger.debug(f"Stream closed by Twitter with response {response}")
@@ -0,0 +1,102 @@
+"""Offline stand-ins for the tweepy and spotipy clients used by `PlaylistterBot`.
+
+Every call sleeps for an injectable latency and is counted, so benchmarks can report API calls per reply.
+"""
+import datetime
+import itertools
+import threading
+import time
+from collections import Counter
+from types import SimpleNamespace
+from typing import Dict, List, Optional
+
+
+class CallRecorder:
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._lock = threading.Lock()
+
+    def record(self, name: str):
+        with self._lock:
+            self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+
+class FakeTwitterAPI(CallRecorder):
+    """Stands in for `tweepy.API`. Sent replies are timestamped so end-to-end latency can be measured"""
+
+    def __init__(self, latency: float, screen_name: str = "playlistter", user_id: int = 1):
+        super().__init__(latency)
+        self.user = SimpleNamespace(id=user_id, id_str=str(user_id), screen_name=screen_name)
+        self.root_tweet = SimpleNamespace(id=1000, id_str="1000", author=self.user, created_at=datetime.datetime.now(tz=datetime.timezone.utc))
+        self._tweet_ids = itertools.count(self.root_tweet.id + 1)
+        self.last_response = None
+        self.sent_at: Dict[int, float] = {}
+
+    def verify_credentials(self):
+        self.record("verify_credentials")
+        return self.user
+
+    def user_timeline(self, **kwargs):
+        self.record("user_timeline")
+        return [self.root_tweet]
+
+    def update_status(self, status: str, in_reply_to_status_id: Optional[int] = None, **kwargs):
+        self.record("update_status")
+        if in_reply_to_status_id is not None:
+            self.sent_at[int(in_reply_to_status_id)] = time.perf_counter()
+        tweet_id = next(self._tweet_ids)
+        return SimpleNamespace(id=tweet_id, id_str=str(tweet_id), text=status)
+
+
+class FakeSpotify(CallRecorder):
+    """Stands in for `spotipy.Spotify`. Search resolves the first word of the query to a track by `Benchmark Artist`,
+    so synthetic suggestions should look like `<one-word title> - Benchmark Artist`. Every playlist starts out with the same tracks"""
+
+    def __init__(self, latency: float, playlist_size: int = 250):
+        super().__init__(latency)
+        self.playlist_size = playlist_size
+        self.playlists: Dict[str, List[str]] = {}
+        self.snapshot = 0
+        self._lock = threading.Lock()
+
+    def me(self):
+        self.record("me")
+        return {"id": "playlistter"}
+
+    def playlist(self, playlist_id: str, fields: Optional[str] = None):
+        self.record("playlist")
+        return {"snapshot_id": str(self.snapshot)}
+
+    def playlist_items(self, playlist_id: str, fields: Optional[str] = None, limit: int = 100, offset: int = 0):
+        self.record("playlist_items")
+        return self._page(playlist_id, offset, limit)
+
+    def next(self, result: dict):
+        self.record("playlist_items")
+        return self._page(result["playlist_id"], result["offset"] + result["limit"], result["limit"])
+
+    def playlist_add_items(self, playlist_id: str, items: List[str]):
+        self.record("playlist_add_items")
+        with self._lock:
+            self.tracks(playlist_id).extend(items)
+            self.snapshot += 1
+            return {"snapshot_id": str(self.snapshot)}
+
+    def search(self, q: str, type: str = "track", limit: int = 30):
+        self.record("search")
+        # Suggestions are written song or artist first, the synthetic song names are the ones starting with `song`
+        words = q.replace("track:", "").replace("artist:", "").split()
+        title = next((word for word in words if word.startswith("song")), words[0])
+        return {"tracks": {"items": [{"name": title, "artists": [{"name": "Benchmark Artist"}], "popularity": 50, "uri": f"spotify:track:{title}"}]}}
+
+    def tracks(self, playlist_id: str) -> List[str]:
+        return self.playlists.setdefault(playlist_id, [f"spotify:track:existing{i}" for i in range(self.playlist_size)])
+
+    def _page(self, playlist_id: str, offset: int, limit: int) -> dict:
+        tracks = self.tracks(playlist_id)
+        items = [{"track": {"uri": uri}} for uri in tracks[offset:offset + limit]]
+        return {"items": items, "playlist_id": playlist_id, "offset": offset, "limit": limit,
+                "next": "next" if offset + limit < len(tracks) else None}
@@ -0,0 +1,199 @@
+"""Offline throughput benchmark for the reply pipeline.
+
+Drives `TwitterReplyWatcher.on_response` with a synthetic reply stream, spread over one or more campaigns, against fake Twitter/Spotify clients
+(and mongomock, if installed and `--mongo` is passed), then reports replies/sec, end-to-end latency and API calls per reply.
+mongomock doesn't keep up with pymongo's bulk operations, so with `--mongo` the bot writes its state directly instead of in batches.
+`--replay` feeds the replies recorded in a reply log (`reply_log_dir`) back through the pipeline instead, e.g. to load test with a real day.
+
+    python -m benchmarks.reply_pipeline --replies 2000 --rate 0 --duplicate-ratio 0.5 --spam-ratio 0.2 --latency-ms 20
+    python -m benchmarks.reply_pipeline --replay reply_log/2022-08-01.jsonl
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+from typing import List, Optional
+
+from loguru import logger
+
+# The bot reads its settings from the environment at import time. None of these are used offline
+for setting in ["twitter_api_key", "twitter_api_secret", "twitter_token", "twitter_token_secret", "twitter_bearer_token",
+                "spotify_client_id", "spotify_client_secret", "spotify_playlist_id", "spotify_dc", "spotify_key",
+                "mongo_host", "mongo_port", "mongo_user", "mongo_password"]:
+    os.environ.setdefault(setting, "benchmark")
+
+
+# Ways people write the same suggestion, all of them should resolve to the same track
+SONG_VARIANTS = ["Benchmark Artist - {song}", "{song} by Benchmark Artist", "{song} — Benchmark Artist 🎶",
+                 "{song} ft. Somebody - Benchmark Artist", "benchmark artist ~ {song} (feat. Somebody)"]
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--replies", type=int, default=1000, help="number of replies to stream")
+    parser.add_argument("--rate", type=float, default=0, help="replies per second to stream, 0 streams as fast as possible")
+    parser.add_argument("--users", type=int, default=500, help="number of distinct users replying")
+    parser.add_argument("--songs", type=int, default=200, help="number of distinct songs suggested")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.3, help="share of replies suggesting one of the 10 most popular songs")
+    parser.add_argument("--variant-ratio", type=float, default=0.3,
+                        help="share of replies writing their song differently (artist first, `by`, `ft.`, emoji)")
+    parser.add_argument("--spam-ratio", type=float, default=0.1, help="share of replies sent by the 5 spammiest users")
+    parser.add_argument("--campaigns", type=int, default=1, help="number of campaigns (each with its own playlist) replies are spread over")
+    parser.add_argument("--latency-ms", type=float, default=20, help="latency injected into every fake API call")
+    parser.add_argument("--mongo", action="store_true", help="back bot state with mongomock instead of keeping it in memory")
+    parser.add_argument("--rate-limits", action="store_true", help="apply the real API rate limits instead of unlimited fake APIs")
+    parser.add_argument("--record", metavar="DIR", help="write the bot's reply log to this directory, for a later --replay")
+    parser.add_argument("--replay", metavar="PATH", help="replay the replies of a reply log file (or directory of them) instead of synthetic ones")
+    parser.add_argument("--seed", type=int, default=7)
+    return parser.parse_args(argv)
+
+
+def synthetic_replies(args: argparse.Namespace, screen_name: str, campaigns: list):
+    """Yield stream responses to random campaigns, with a configurable share of popular-song duplicates and of spamming users"""
+    from tweepy import StreamResponse, StreamRule, Tweet
+
+    rng = random.Random(args.seed)
+    for i in range(args.replies):
+        campaign = rng.choice(campaigns)
+        author_id = rng.randrange(5) + 2 if rng.random() < args.spam_ratio else rng.randrange(args.users) + 7
+        song = rng.randrange(10) if rng.random() < args.duplicate_ratio else rng.randrange(args.songs)
+        text = rng.choice(SONG_VARIANTS).format(song=f"song{song}") if rng.random() < args.variant_ratio else f"song{song} - Benchmark Artist"
+        reply = Tweet({"id": str(10 ** 9 + i),
+                       "text": f"@{screen_name} {text}",
+                       "author_id": str(author_id),
+                       "conversation_id": campaign.root_tweet_id})
+        yield StreamResponse(reply, {}, [], [StreamRule(tag=campaign.name)])
+
+
+def recorded_replies(path: str):
+    """Yield the replies recorded in a reply log file, or in every day file of a reply log directory, as stream responses"""
+    from tweepy import StreamResponse, StreamRule, Tweet
+
+    from models.reply_event_log import ReplyEventLog, STAGE_RECEIVED
+
+    paths = ReplyEventLog(path).day_files() if os.path.isdir(path) else [path]
+    for log_path in paths:
+        for record in ReplyEventLog.read(log_path):
+            if record["stage"] == STAGE_RECEIVED:
+                yield StreamResponse(Tweet(record["tweet"]), {}, [], [StreamRule(tag=record["campaign"])])
+
+
+def combined_stats(campaigns: list) -> dict:
+    """Sum the reply worker stats of every campaign's lane"""
+    stats = Counter()
+    for campaign in campaigns:
+        stats.update(campaign.reply_workers.stats())
+    return dict(stats)
+
+
+def wait_until_idle(bot, quiet_seconds: float):
+    """Wait until every queue in the pipeline is drained and no reply was sent for `quiet_seconds`"""
+    last_sent, quiet_since = -1, time.perf_counter()
+    while True:
+        workers = combined_stats(list(bot.campaigns))
+        busy = workers["queue_depth"] or workers["processed"] + workers["failed"] < workers["submitted"] or bot.reply_dispatcher.pending()
+        sent = len(bot.twitter_client.sent_at)
+        if busy or sent != last_sent:
+            last_sent, quiet_since = sent, time.perf_counter()
+        elif time.perf_counter() - quiet_since >= quiet_seconds:
+            return
+        time.sleep(0.05)
+
+
+def run(args: argparse.Namespace) -> dict:
+    from api.playlistter_bot import PlaylistterBot
+    from benchmarks.fakes import FakeSpotify, FakeTwitterAPI
+    from models.campaign_registry import DEFAULT_CAMPAIGN
+    from models.reply_event_log import ReplyEventLog
+    from util import config
+    from util.rate_governor import RateGovernor
+
+    latency = args.latency_ms / 1000
+    twitter, spotify = FakeTwitterAPI(latency), FakeSpotify(latency)
+
+    class OfflinePlaylistterBot(PlaylistterBot):
+        def twitter_login(self):
+            return twitter
+
+        def spotify_login(self):
+            return spotify
+
+    # A replay runs the campaigns it recorded, each with its own fake playlist
+    recorded = list(recorded_replies(args.replay)) if args.replay else None
+    if recorded is not None:
+        args.replies = len(recorded)
+        campaign_playlists = {name: f"benchmark-{name}" for name in {response.matching_rules[0].tag for response in recorded} - {DEFAULT_CAMPAIGN}}
+    else:
+        campaign_playlists = {f"campaign{i}": f"benchmark{i}" for i in range(1, args.campaigns)}
+
+    mongo_db = None
+    if args.mongo:
+        import mongomock
+        mongo_db = mongomock.MongoClient()[config.MONGO_DB]
+
+    bot = OfflinePlaylistterBot(twitter_api_key="", twitter_api_secret="", twitter_token="", twitter_token_secret="",
+                                twitter_bearer_token="", spotify_client_id="", spotify_client_secret="", spotify_perma_token="",
+                                spotify_playlist_id="benchmark", mongo_db=mongo_db, bulk_writes=not args.mongo,
+                                rate_governor=None if args.rate_limits else RateGovernor(limits={}),
+                                event_log=ReplyEventLog(args.record) if args.record else None,
+                                campaigns=campaign_playlists)
+    # The default campaign adopts the fake root tweet, every other campaign gets its own prompt
+    campaigns = list(bot.campaigns)
+    for campaign in campaigns:
+        if not campaign.has_current_root():
+            bot.daily_prompt_for_songs(campaign)
+    startup_calls = twitter.calls + spotify.calls
+
+    received_at = {}
+    start = time.perf_counter()
+    responses = recorded if recorded is not None else synthetic_replies(args, twitter.user.screen_name, campaigns)
+    for i, response in enumerate(responses):
+        if args.rate:
+            time.sleep(max(0.0, start + i / args.rate - time.perf_counter()))
+        received_at[response.data.id] = time.perf_counter()
+        bot.streaming_client.on_response(response)
+    stream_seconds = time.perf_counter() - start
+
+    wait_until_idle(bot, quiet_seconds=config.PLAYLIST_BATCH_WAIT_SECONDS + 0.5)
+    latencies = sorted(twitter.sent_at[reply_id] - received_at[reply_id] for reply_id in twitter.sent_at)
+    elapsed = max(twitter.sent_at.values(), default=start) - start
+    api_calls = twitter.calls + spotify.calls - startup_calls
+
+    return {"replies": args.replies,
+            "stream_seconds": stream_seconds,
+            "replies_per_second": args.replies / elapsed if elapsed else 0.0,
+            "replies_sent": len(latencies),
+            "p50_ms": statistics.median(latencies) * 1000 if latencies else 0.0,
+            "p99_ms": latencies[int(0.99 * (len(latencies) - 1))] * 1000 if latencies else 0.0,
+            "api_calls_per_reply": sum(api_calls.values()) / args.replies,
+            "api_calls": dict(api_calls),
+            "search_cache": bot.search_cache.stats(),
+            "reply_workers": combined_stats(campaigns),
+            "reply_dispatcher": bot.reply_dispatcher.stats(),
+            "alias_index": bot.alias_index.stats(),
+            "playlist_flushes": sum(buffer.flushes for buffer in bot.playlist_add_buffers.values()),
+            "metrics": bot.metrics.summary()}
+
+
+def report(results: dict):
+    print(f"replies streamed:     {results['replies']} in {results['stream_seconds']:.2f}s")
+    print(f"throughput:           {results['replies_per_second']:.1f} replies/s")
+    print(f"replies sent:         {results['replies_sent']}")
+    print(f"end-to-end latency:   p50 {results['p50_ms']:.1f}ms, p99 {results['p99_ms']:.1f}ms")
+    print(f"API calls per reply:  {results['api_calls_per_reply']:.3f} {results['api_calls']}")
+    print(f"search cache:         {results['search_cache']}")
+    print(f"alias index:          {results['alias_index']}")
+    print(f"reply workers:        {results['reply_workers']}")
+    print(f"reply dispatcher:     {results['reply_dispatcher']}")
+    print(f"playlist flushes:     {results['playlist_flushes']}")
+    print(f"spans:\n{results['metrics']}")
+
+
+if __name__ == '__main__':
+    # Keep the benchmark output readable, only warnings and errors from the bot itself
+    logger.remove()
+    logger.add(sys.stderr, level="WARNING")
+    report(run(parse_args()))
@@ -1,86 +1,78 @@
+import asyncio
 import datetime
 import sys
-from typing import List
+import threading
+from typing import Optional, Type
 
 from apscheduler.events import EVENT_JOB_SUBMITTED, EVENT_JOB_ADDED
 from apscheduler.jobstores.mongodb import MongoDBJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.schedulers.background import BackgroundScheduler
+from apscheduler.schedulers.base import BaseScheduler
 from apscheduler.schedulers.blocking import BlockingScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
 from loguru import logger
-from tweepy.models import Status
+from pymongo import MongoClient
 
 from api import mongo_client
 from api.playlistter_bot import PlaylistterBot
+from models.reply_event_log import ReplyEventLog
 from util import helpers, config
+from util.metrics import Metrics, MongoCommandTimer
 
 logger.remove()  # Remove default logger to avoid dupe logs
+# The only sink for the whole bot, modules just import `logger`
 logger.add(sys.stderr, format="<lvl> {level} - {message}</lvl>", level="DEBUG", colorize=True, backtrace=True, diagnose=True, catch=True)
-logger.add(sys.stderr, format="<lvl> {level} - {message}</lvl>", filter="apscheduler", level="DEBUG", colorize=True, backtrace=True,
-           diagnose=True, catch=True)
 
 
-def new_day_tasks():
-    logger.info("Starting new day tasks")
+def prepare_day():
+    """Prompt for songs in every campaign that wasn't prompted yet today and catch up on missed replies"""
+    for campaign in playlistter.campaigns:
+        # If I've not already tweeted today then prompt for songs. The reply ledger is keyed by day, so there's nothing to clear
+        if not campaign.has_current_root():
+            playlistter.daily_prompt_for_songs(campaign)
 
-    # Check if I've tweeted today already
-    last_tweet: List[Status] = playlistter.get_last_tweet()
+        # Record replies that arrived while the bot was down. Only replies newer than the stored checkpoint are fetched
+        for reply in playlistter.get_previous_replies_to_tweet(campaign.root_tweet_id):
+            logger.debug(f"Previous song suggestion to {campaign.name} by {reply.author_id}: {reply.text}")
+            campaign.reply_ledger.record(reply.author_id, reply.id, reply.text.strip())
 
-    # If I've not already tweeted today then clear reply map and prompt for songs
-    if not last_tweet or (last_tweet[0].created_at.astimezone(helpers.EASTERN_TZ).date() != datetime.datetime.now().astimezone(
-            helpers.EASTERN_TZ).date()):
-        helpers.clear_user_reply_map()
-        playlistter.daily_prompt_for_songs()
 
-    # Get last tweet again in case we didn't have one before (kinda wasteful tbh)
-    last_tweet: Status = playlistter.get_last_tweet()[0]
-
-    # If script is restarting, then grab previous replies to daily tweet to popular user map
-    previous_replies: List[Status] = playlistter.get_previous_replies_to_tweet()
+def new_day_tasks():
+    logger.info("Starting new day tasks")
+    prepare_day()
+    if playlistter.event_log is not None:
+        playlistter.event_log.prune()
 
-    # Populate the reply map with all replies to the last tweet
-    helpers.populate_user_replies_map(previous_replies)
+    # Watch for new replies. An already connected stream is kept and only has its rules swapped if a root tweet changed
+    logger.debug("Ensuring stream is watching every campaign")
+    playlistter.start_new_stream()
 
-    # If this is started by a new day as opposed to the script dying, then kill the current stream before starting a new one
-    logger.debug("Killing current stream")
-    playlistter.kill_stream()
 
-    # Watch for new replies by starting a new stream
-    logger.debug("Starting new stream")
+async def async_new_day_tasks():
+    logger.info("Starting new day tasks")
+    await asyncio.to_thread(prepare_day)
+    if playlistter.event_log is not None:
+        await asyncio.to_thread(playlistter.event_log.prune)
 
-    playlistter.start_new_stream(last_tweet)
+    logger.debug("Ensuring stream is watching every campaign")
+    await engine.start_new_stream()
 
 
 def scheduler_callback(event):
+    # The stream supervisor keeps the stream across job runs, so there's nothing to tear down here anymore
     logger.debug(f"""Scheduler callback triggered: {event}""")
 
-    # Kill current twitter stream (if any) on new job event
-    if event.job_id:
-        playlistter.kill_stream()
 
-
-if __name__ == '__main__':
-    # Create PlaylistterBot instance to handle both the Twitter and Spotify APIs
-    playlistter = PlaylistterBot(twitter_api_key=config.TWITTER_API_KEY,
-                                 twitter_api_secret=config.TWITTER_API_SECRET,
-                                 twitter_token=config.TWITTER_TOKEN,
-                                 twitter_token_secret=config.TWITTER_TOKEN_SECRET,
-                                 twitter_bearer_token=config.TWITTER_BEARER_TOKEN,
-                                 spotify_client_id=config.SPOTIFY_CLIENT_ID,
-                                 spotify_client_secret=config.SPOTIFY_CLIENT_SECRET,
-                                 spotify_playlist_id=config.SPOTIFY_PLAYLIST_ID,
-                                 spotify_perma_token=config.SPOTIFY_PERMA_TOKEN, )
-
-    # Create mongo client
-    mongo = mongo_client.login(username=config.MONGO_USER, password=config.MONGO_PASSWORD, hostname=config.MONGO_HOST)
-
-    # Create Scheduler job
-    scheduler = BlockingScheduler(timezone=helpers.EASTERN_TZ,
-                                  jobstores={'mongo': MongoDBJobStore(client=mongo)},
-                                  job_defaults={'misfire_grace_time': None, 'coalesce': True})
+def create_scheduler(scheduler_class: Type[BaseScheduler], mongo: MongoClient, day_job) -> BaseScheduler:
+    # Create Scheduler job. The job store reuses the bot's pooled mongo client instead of opening its own connections
+    scheduler = scheduler_class(timezone=helpers.EASTERN_TZ,
+                                jobstores={'mongo': MongoDBJobStore(client=mongo)},
+                                job_defaults={'misfire_grace_time': None, 'coalesce': True})
 
     # cron daily at 03:30am ET
-    logger.info("Starting scheduler")
-    scheduler.add_job(new_day_tasks,
+    scheduler.add_job(day_job,
                       id="playlistter",
                       name="playlistter",
                       replace_existing=True,
@@ -89,11 +81,117 @@ if __name__ == '__main__':
                       next_run_time=datetime.datetime.now(tz=helpers.EASTERN_TZ) + datetime.timedelta(minutes=1)
                       )
 
-    # Add callback to scheduler to kill twitter stream on new runs
+    # Periodically reconcile the local playlist index in case the playlist was edited outside the bot
+    scheduler.add_job(playlistter.reconcile_playlist_index,
+                      id="playlist_index_reconcile",
+                      name="playlist_index_reconcile",
+                      replace_existing=True,
+                      trigger=IntervalTrigger(minutes=config.PLAYLIST_RECONCILE_MINUTES, timezone=helpers.EASTERN_TZ))
+
+    # Periodically log where the time per reply goes
+    scheduler.add_job(playlistter.log_metrics_summary,
+                      id="metrics_summary",
+                      name="metrics_summary",
+                      replace_existing=True,
+                      trigger=IntervalTrigger(minutes=config.METRICS_SUMMARY_MINUTES, timezone=helpers.EASTERN_TZ))
+
+    # Add callback to scheduler to log job runs
     scheduler.add_listener(scheduler_callback, EVENT_JOB_SUBMITTED | EVENT_JOB_ADDED)
+    return scheduler
+
 
+async def run_async_engine(mongo: MongoClient):
+    global engine
+    # Only imported here since the asyncio engine needs tweepy's optional `async` extra
+    from api.async_engine import AsyncPlaylistterEngine
+
+    engine = AsyncPlaylistterEngine(playlistter,
+                                    twitter_concurrency=config.ASYNC_TWITTER_CONCURRENCY,
+                                    spotify_concurrency=config.ASYNC_SPOTIFY_CONCURRENCY,
+                                    mongo_concurrency=config.ASYNC_MONGO_CONCURRENCY,
+                                    initial_backoff=config.STREAM_RECONNECT_BACKOFF_SECONDS,
+                                    max_backoff=config.STREAM_RECONNECT_MAX_BACKOFF_SECONDS)
+    # Without the threaded engine's reply workers, replies that need the whole pipeline again become engine tasks
+    playlistter.replay_unfinished(submit=engine.submit)
+
+    logger.info("Starting asyncio scheduler")
+    scheduler = create_scheduler(AsyncIOScheduler, mongo, async_new_day_tasks)
+    scheduler.start()
+
+    # The scheduler and the stream run as tasks on this loop, so just keep it alive until the loop is shut down
     try:
+        await asyncio.Event().wait()
+    finally:
+        scheduler.shutdown(wait=False)
+        engine.kill_stream()
+
+
+def run_cluster(mongo: MongoClient):
+    # Only the leader runs the scheduler (and so the daily prompt and the stream), every replica processes queued replies
+    scheduler: Optional[BaseScheduler] = None
+
+    def on_elected():
+        nonlocal scheduler
+        logger.info("Elected leader, starting scheduler")
+        scheduler = create_scheduler(BackgroundScheduler, mongo, new_day_tasks)
         scheduler.start()
+
+    def on_demoted():
+        logger.warning("Lost leadership, stopping scheduler and stream")
+        if scheduler is not None:
+            scheduler.shutdown(wait=False)
+        # Stopping joins the stream thread, which can take longer than a lease. Doing that here would block lease renewals
+        threading.Thread(target=playlistter.kill_stream, name="stream-stop", daemon=True).start()
+
+    playlistter.start_cluster(on_elected, on_demoted)
+    # The scheduler, stream and queue consumer all run on their own threads, so just keep the process alive
+    threading.Event().wait()
+
+
+if __name__ == '__main__':
+    # Shared by the bot and the mongo client, so mongo commands show up next to the twitter and spotify calls
+    metrics = Metrics()
+    if config.METRICS_PORT:
+        metrics.serve(config.METRICS_PORT, config.METRICS_HOST)
+
+    # Create mongo client
+    mongo = mongo_client.login(username=config.MONGO_USER, password=config.MONGO_PASSWORD, hostname=config.MONGO_HOST,
+                               event_listeners=[MongoCommandTimer(metrics)])
+
+    # Create PlaylistterBot instance to handle both the Twitter and Spotify APIs
+    playlistter = PlaylistterBot(twitter_api_key=config.TWITTER_API_KEY,
+                                 twitter_api_secret=config.TWITTER_API_SECRET,
+                                 twitter_token=config.TWITTER_TOKEN,
+                                 twitter_token_secret=config.TWITTER_TOKEN_SECRET,
+                                 twitter_bearer_token=config.TWITTER_BEARER_TOKEN,
+                                 spotify_client_id=config.SPOTIFY_CLIENT_ID,
+                                 spotify_client_secret=config.SPOTIFY_CLIENT_SECRET,
+                                 spotify_playlist_id=config.SPOTIFY_PLAYLIST_ID,
+                                 spotify_perma_token=config.get_spotify_perma_token,
+                                 mongo_db=mongo_client.get_database(mongo, config.MONGO_DB),
+                                 metrics=metrics,
+                                 event_log=ReplyEventLog(config.REPLY_LOG_DIR,
+                                                         fsync=config.REPLY_LOG_FSYNC,
+                                                         retention_days=config.REPLY_LOG_RETENTION_DAYS) if config.REPLY_LOG_DIR else None,
+                                 campaigns=config.CAMPAIGNS,
+                                 cluster_node_id=config.CLUSTER_NODE_ID if config.CLUSTER_MODE else None,
+                                 threaded_engine=config.ENGINE != "asyncio")
+
+    # Finish whatever the previous run was in the middle of before taking new replies. The asyncio engine does so once it's running
+    if playlistter.threaded_engine:
+        playlistter.replay_unfinished()
+
+    try:
+        if config.CLUSTER_MODE:
+            if config.ENGINE == "asyncio":
+                raise ValueError("Cluster mode only supports the threaded engine")
+            logger.info(f"Starting in cluster mode as {config.CLUSTER_NODE_ID}")
+            run_cluster(mongo)
+        elif config.ENGINE == "asyncio":
+            asyncio.run(run_async_engine(mongo))
+        else:
+            logger.info("Starting scheduler")
+            create_scheduler(BlockingScheduler, mongo, new_day_tasks).start()
     except Exception:
         logger.exception(f"Exiting scheduler with exception!")
         sys.exit(1)
\ No newline at end of file
@@ -0,0 +1,161 @@
+import datetime
+import re
+import threading
+from typing import Dict, Iterator, NamedTuple, Optional, Set
+
+from loguru import logger
+from pymongo.collection import Collection
+
+from models.mongo_bulk_writer import MongoBulkWriter
+from util import helpers
+
+# Featured artists are left out of the signature, from the `ft.` up to the next separator or bracket
+FEATURING_PATTERN = re.compile(r"\b(?:ft|feat|featuring)\b\.?[^-–—~|:()\[\]]*", re.IGNORECASE)
+NOISE_TOKENS = {"by"}
+
+SOURCE_LEARNED = "learned"
+SOURCE_ADMIN = "admin"
+
+
+class Alias(NamedTuple):
+    uri: str
+    confidence: float
+    source: str
+
+
+def signature(text: str) -> str:
+    """Reduce a suggestion to its sorted set of words, so `song - artist`, `artist — song 🎶` and `song by artist ft. x` all
+    share one key"""
+    tokens = set(helpers.normalize_query(FEATURING_PATTERN.sub(" ", text)).split()) - NOISE_TOKENS
+    return " ".join(sorted(tokens))
+
+
+class AliasIndex:
+    """Every suggestion the bot ever resolved, keyed by its token `signature`, so repeats of a known track written a little
+    differently resolve without a search.
+
+    Each alias keeps the match confidence of the search that produced it, and is only used at or above `min_confidence`.
+    A learned alias is only replaced by a more confident match. Aliases set through `python -m util.alias_admin` are never
+    replaced. The whole index is held in memory, and when a mongo collection is given it is persisted there and re-read
+    every `reload_seconds` so corrections made with the admin tool reach running bots. Reloads keep what was learned locally
+    but isn't in mongo yet (e.g. still buffered in the bulk `writer`).
+    """
+
+    def __init__(self, min_confidence: float, reload_seconds: float, collection: Optional[Collection] = None,
+                 writer: Optional[MongoBulkWriter] = None):
+        self.min_confidence = min_confidence
+        self.reload_seconds = reload_seconds
+        self.collection = collection
+        self.writer = writer
+        self.hits = 0
+        self.misses = 0
+        self.learned = 0
+        self._aliases: Dict[str, Alias] = {}
+        # Learned aliases mongo hasn't caught up with yet
+        self._unsaved: Set[str] = set()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        return len(self._aliases)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(list(self._aliases))
+
+    def load(self):
+        if self.collection is None:
+            return
+        aliases = {doc["_id"]: Alias(doc["uri"], doc["confidence"], doc["source"]) for doc in self.collection.find()}
+        with self._lock:
+            for key in list(self._unsaved):
+                stored, learned = aliases.get(key), self._aliases.get(key)
+                if learned and (stored is None or (stored.source != SOURCE_ADMIN and stored.confidence < learned.confidence)):
+                    aliases[key] = learned
+                else:  # Saved by now, or superseded by something mongo had already
+                    self._unsaved.discard(key)
+            self._aliases = aliases
+        logger.debug(f"Loaded {len(aliases)} song aliases")
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="alias-index-reload", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    def lookup(self, text: str) -> Optional[Alias]:
+        return self._aliases.get(signature(text))
+
+    def get(self, text: str) -> Optional[str]:
+        """The track URI a suggestion resolves to, if it is a confident alias of a known track"""
+        alias = self.lookup(text)
+        with self._lock:
+            if alias and alias.confidence >= self.min_confidence:
+                self.hits += 1
+                return alias.uri
+            self.misses += 1
+        return None
+
+    def learn(self, text: str, uri: str, confidence: float):
+        """Remember what a suggestion resolved to, unless a more confident or admin-set alias already exists"""
+        key = signature(text)
+        if not key:
+            return
+        with self._lock:
+            current = self._aliases.get(key)
+            if current and (current.source == SOURCE_ADMIN or current.confidence >= confidence):
+                return
+            self._aliases[key] = Alias(uri, confidence, SOURCE_LEARNED)
+            self.learned += 1
+            if self.collection is not None:
+                self._unsaved.add(key)
+
+        if self.collection is not None:
+            # Insert the alias if it's new, otherwise only replace a less confident learned one. Neither write runs into a correction
+            # made since the last reload, and both give the same result in either order, so they can go into one unordered batch
+            alias = {"uri": uri, "confidence": confidence, "source": SOURCE_LEARNED, "text": text,
+                     "updated_at": datetime.datetime.now(tz=datetime.timezone.utc)}
+            self._update_one({"_id": key}, {"$setOnInsert": alias}, upsert=True)
+            self._update_one({"_id": key, "source": {"$ne": SOURCE_ADMIN}, "confidence": {"$lt": confidence}}, {"$set": alias}, upsert=False)
+
+    def pin(self, text: str, uri: str):
+        """Set the alias by hand, e.g. to correct a bad match. Pinned aliases are always used and never replaced by learning"""
+        key = signature(text)
+        with self._lock:
+            self._aliases[key] = Alias(uri, 1.0, SOURCE_ADMIN)
+            self._unsaved.discard(key)
+        if self.collection is not None:
+            self.collection.update_one({"_id": key},
+                                       {"$set": {"uri": uri, "confidence": 1.0, "source": SOURCE_ADMIN, "text": text,
+                                                 "updated_at": datetime.datetime.now(tz=datetime.timezone.utc)}},
+                                       upsert=True)
+
+    def forget(self, text: Optional[str] = None, uri: Optional[str] = None) -> int:
+        """Drop the alias of a suggestion, or every alias pointing to a track. Returns how many were dropped"""
+        with self._lock:
+            keys = [key for key, alias in self._aliases.items() if (text is not None and key == signature(text)) or alias.uri == uri]
+            for key in keys:
+                del self._aliases[key]
+                self._unsaved.discard(key)
+        if self.collection is None:
+            return len(keys)
+        return self.collection.delete_many({"_id": signature(text)} if text is not None else {"uri": uri}).deleted_count
+
+    def _update_one(self, filter: dict, update: dict, upsert: bool):
+        if self.writer is not None:
+            self.writer.update_one(self.collection, filter, update, upsert=upsert)
+        else:
+            self.collection.update_one(filter, update, upsert=upsert)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "learned": self.learned, "size": len(self._aliases)}
+
+    # noinspection PyBroadException
+    def _run(self):
+        while not self._stopping.wait(self.reload_seconds):
+            try:
+                self.load()
+            except Exception:
+                logger.exception("Failed to reload song aliases")
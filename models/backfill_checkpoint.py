@@ -0,0 +1,48 @@
+import threading
+from typing import Dict, Optional
+
+from loguru import logger
+from pymongo.collection import Collection
+
+from models.mongo_bulk_writer import MongoBulkWriter
+
+
+class BackfillCheckpoint:
+    """Newest reply id every backfill of a root tweet has read up to, so the next one can resume with `since_id` instead of rescanning.
+
+    Checkpoints only ever move forward. Without a collection they are kept in memory only.
+    The mongo writes go through the bulk `writer` when one is given.
+    """
+
+    def __init__(self, collection: Optional[Collection] = None, writer: Optional[MongoBulkWriter] = None):
+        self.collection = collection
+        self.writer = writer
+        self._checkpoints: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def get(self, root_tweet_id) -> Optional[int]:
+        root_tweet_id = str(root_tweet_id)
+        with self._lock:
+            if root_tweet_id in self._checkpoints:
+                return self._checkpoints[root_tweet_id]
+
+        if self.collection is None:
+            return None
+        doc = self.collection.find_one({"_id": root_tweet_id})
+        if not doc:
+            return None
+        with self._lock:
+            self._checkpoints[root_tweet_id] = max(self._checkpoints.get(root_tweet_id, 0), doc["since_id"])
+            return self._checkpoints[root_tweet_id]
+
+    def advance(self, root_tweet_id, tweet_id):
+        root_tweet_id, tweet_id = str(root_tweet_id), int(tweet_id)
+        with self._lock:
+            if tweet_id <= self._checkpoints.get(root_tweet_id, 0):
+                return
+            self._checkpoints[root_tweet_id] = tweet_id
+        if self.writer is not None and self.collection is not None:
+            self.writer.update_one(self.collection, {"_id": root_tweet_id}, {"$max": {"since_id": tweet_id}})
+        elif self.collection is not None:
+            self.collection.update_one({"_id": root_tweet_id}, {"$max": {"since_id": tweet_id}}, upsert=True)
+        logger.debug(f"Advanced reply checkpoint for {root_tweet_id} to {tweet_id}")
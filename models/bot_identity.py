@@ -0,0 +1,41 @@
+import threading
+from typing import Callable, Optional
+
+import tweepy
+from loguru import logger
+
+
+class BotIdentity:
+    """Caches the logged-in twitter user so `verify_credentials` is called once per login instead of once per tweet.
+
+    The cached user is only re-resolved through `refresh`, which should be called when twitter reports an auth error.
+    `verify_credentials` goes through `governed` (e.g. the bot's rate governor), if given.
+    """
+
+    def __init__(self, twitter_client: tweepy.API, governed: Optional[Callable[[Callable], Callable]] = None):
+        self.twitter_client = twitter_client
+        self.governed = governed or (lambda func: func)
+        self._user: Optional[tweepy.models.User] = None
+        self._lock = threading.Lock()
+
+    @property
+    def user(self) -> tweepy.models.User:
+        if self._user is None:
+            with self._lock:
+                if self._user is None:
+                    self._user = self.governed(self.twitter_client.verify_credentials)()
+        return self._user
+
+    @property
+    def user_id(self) -> int:
+        return self.user.id
+
+    @property
+    def screen_name(self) -> str:
+        return self.user.screen_name
+
+    def refresh(self) -> tweepy.models.User:
+        logger.info("Refreshing logged-in twitter user")
+        with self._lock:
+            self._user = self.governed(self.twitter_client.verify_credentials)()
+        return self._user
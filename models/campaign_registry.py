@@ -0,0 +1,109 @@
+import threading
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from loguru import logger
+from pymongo.collection import Collection
+from tweepy import StreamRule, Tweet
+
+from models.playlist_add_buffer import PlaylistAddBuffer
+from models.playlist_index import PlaylistIndex
+from models.reply_ledger import ReplyLedger
+from models.reply_worker_pool import ReplyWorkerPool
+from models.stream_supervisor import StreamSupervisor
+from util import helpers
+
+DEFAULT_CAMPAIGN = "default"
+
+
+class Campaign:
+    """One themed daily thread: the root tweet replies are collected from, the playlist they go to and the ledger of who
+    already suggested a song today. Each campaign gets its own reply worker lane"""
+
+    def __init__(self, name: str, playlist_id: str, playlist_index: PlaylistIndex, playlist_add_buffer: PlaylistAddBuffer,
+                 reply_ledger: ReplyLedger):
+        self.name = name
+        self.playlist_id = playlist_id
+        self.playlist_index = playlist_index
+        self.playlist_add_buffer = playlist_add_buffer
+        self.reply_ledger = reply_ledger
+        self.reply_workers: Optional[ReplyWorkerPool] = None
+        self.root_tweet_id: Optional[str] = None
+        self.root_day: Optional[str] = None
+
+    def __repr__(self) -> str:
+        return f"Campaign({self.name!r}, playlist={self.playlist_id!r}, root={self.root_tweet_id!r})"
+
+    @property
+    def playlist_url(self) -> str:
+        return f"https://open.spotify.com/playlist/{self.playlist_id}"
+
+    @property
+    def stream_rule(self) -> Optional[str]:
+        return StreamSupervisor.rule_for(self.root_tweet_id) if self.root_tweet_id else None
+
+    def has_current_root(self) -> bool:
+        """Whether today's prompt was already tweeted for this campaign"""
+        return self.root_tweet_id is not None and self.root_day == helpers.current_day()
+
+
+class CampaignRegistry:
+    """Every campaign this process runs, keyed by name and by root tweet.
+
+    The campaign name doubles as the tag of its stream rule, so all campaigns share a single filtered stream.
+    The root tweet of each campaign is persisted in the optional mongo collection so a restart picks up the same threads.
+    """
+
+    def __init__(self, collection: Optional[Collection] = None):
+        self.collection = collection
+        self._campaigns: Dict[str, Campaign] = {}
+        self._by_root: Dict[str, Campaign] = {}
+        self._stored_roots: Dict[str, Tuple[str, str]] = {}
+        self._lock = threading.Lock()
+
+    def __iter__(self) -> Iterator[Campaign]:
+        return iter(list(self._campaigns.values()))
+
+    def __len__(self) -> int:
+        return len(self._campaigns)
+
+    def add(self, campaign: Campaign):
+        """Register a campaign, picking up the root tweet stored for it by `load_roots`"""
+        with self._lock:
+            self._campaigns[campaign.name] = campaign
+        if campaign.name in self._stored_roots:
+            self._set_root(campaign, *self._stored_roots[campaign.name])
+            logger.debug(f"Restored {campaign}")
+
+    def get(self, name: str) -> Campaign:
+        return self._campaigns[name]
+
+    def load_roots(self):
+        """Read the stored root tweet of every campaign from mongo, they're applied as the campaigns are added"""
+        if self.collection is None:
+            return
+        self._stored_roots = {doc["_id"]: (doc["root_tweet_id"], doc["root_day"]) for doc in self.collection.find()}
+
+    def set_root(self, campaign: Campaign, root_tweet_id, day: Optional[str] = None):
+        """Point the campaign at a new root tweet, e.g. after tweeting its daily prompt"""
+        root_tweet_id, day = str(root_tweet_id), day or helpers.current_day()
+        self._set_root(campaign, root_tweet_id, day)
+        if self.collection is not None:
+            self.collection.update_one({"_id": campaign.name}, {"$set": {"root_tweet_id": root_tweet_id, "root_day": day}}, upsert=True)
+
+    def stream_rules(self) -> Dict[str, str]:
+        """The stream rule (value -> tag) of every campaign that has a root tweet"""
+        return {campaign.stream_rule: campaign.name for campaign in self if campaign.stream_rule}
+
+    def route(self, tweet: Tweet, matching_rules: Optional[List[StreamRule]] = None) -> Optional[Campaign]:
+        """Find the campaign a streamed tweet belongs to, by the tag of the rule it matched or else by its conversation"""
+        for rule in matching_rules or []:
+            if rule.tag in self._campaigns:
+                return self._campaigns[rule.tag]
+        return self._by_root.get(str(tweet.conversation_id))
+
+    def _set_root(self, campaign: Campaign, root_tweet_id: str, day: str):
+        with self._lock:
+            if campaign.root_tweet_id:
+                self._by_root.pop(campaign.root_tweet_id, None)
+            campaign.root_tweet_id, campaign.root_day = root_tweet_id, day
+            self._by_root[root_tweet_id] = campaign
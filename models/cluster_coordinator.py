@@ -0,0 +1,100 @@
+import datetime
+import math
+import threading
+from typing import Callable, Dict, Optional, Set
+
+from loguru import logger
+from pymongo.collection import Collection
+
+from models.mongo_lease import MongoLease
+
+LEADER_LEASE = "leader"
+NODE_LEASE_PREFIX = "node:"
+PARTITION_LEASE_PREFIX = "partition:"
+
+
+class ClusterCoordinator:
+    """Coordinates bot replicas through leases in a shared mongo collection.
+
+    One replica holds the leader lease and owns the scheduler and the stream. The reply queue partitions are spread evenly over
+    every live replica (each keeps a `node:` lease alive as its heartbeat), and each partition is owned by one replica at a time.
+    Leases are renewed every third of `lease_seconds`, so a dead replica's leadership and partitions move on within one lease.
+    """
+
+    def __init__(self, collection: Collection, node_id: str, lease_seconds: float, num_partitions: int,
+                 on_elected: Optional[Callable[[], None]] = None, on_demoted: Optional[Callable[[], None]] = None):
+        self.collection = collection
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.num_partitions = num_partitions
+        self.on_elected = on_elected
+        self.on_demoted = on_demoted
+        self.is_leader = False
+        self._heartbeat = MongoLease(collection, f"{NODE_LEASE_PREFIX}{node_id}", node_id, lease_seconds)
+        self._leader = MongoLease(collection, LEADER_LEASE, node_id, lease_seconds)
+        self._partitions: Dict[int, MongoLease] = {partition: MongoLease(collection, f"{PARTITION_LEASE_PREFIX}{partition}", node_id, lease_seconds)
+                                                   for partition in range(num_partitions)}
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._tick()
+        self._thread = threading.Thread(target=self._run, name="cluster-coordinator", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Hand over leadership and partitions right away instead of letting the leases run out"""
+        self._stopping.set()
+        self._thread.join()
+        if self.is_leader:
+            self._set_leader(False)
+        for lease in [self._leader, self._heartbeat, *self._partitions.values()]:
+            lease.release()
+
+    def partitions(self) -> Set[int]:
+        """The reply queue partitions this replica currently owns"""
+        return {partition for partition, lease in self._partitions.items() if lease.held}
+
+    def live_nodes(self) -> int:
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        return max(1, self.collection.count_documents({"_id": {"$regex": f"^{NODE_LEASE_PREFIX}"}, "expires_at": {"$gt": now}}))
+
+    def stats(self) -> dict:
+        return {"leader": int(self.is_leader), "partitions": len(self.partitions())}
+
+    # noinspection PyBroadException
+    def _run(self):
+        while not self._stopping.wait(self.lease_seconds / 3):
+            try:
+                self._tick()
+            except Exception:
+                # Can't reach mongo, so we can't prove we still hold anything. Leases we don't renew simply expire
+                logger.exception("Failed to renew cluster leases")
+                if self.is_leader and not self._leader.held:
+                    self._set_leader(False)
+
+    def _tick(self):
+        self._heartbeat.acquire()
+        self._set_leader(self._leader.acquire())
+        self._balance_partitions()
+
+    def _set_leader(self, is_leader: bool):
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        logger.info(f"Node {self.node_id} {'is now' if is_leader else 'is no longer'} the leader")
+        callback = self.on_elected if is_leader else self.on_demoted
+        if callback:
+            callback()
+
+    def _balance_partitions(self):
+        # Keep what we own, give back anything over our fair share, then pick up free partitions until we reach it
+        share = math.ceil(self.num_partitions / self.live_nodes())
+        owned = [partition for partition, lease in self._partitions.items() if lease.held and lease.acquire()]
+        for partition in owned[share:]:
+            self._partitions[partition].release()
+        for partition, lease in self._partitions.items():
+            if len(owned) >= share:
+                break
+            if partition not in owned and lease.acquire():
+                owned.append(partition)
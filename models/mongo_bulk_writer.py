@@ -0,0 +1,98 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from loguru import logger
+from pymongo import ReplaceOne, UpdateOne
+from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
+
+
+class MongoBulkWriter:
+    """Buffers bot state writes that nothing waits on and sends them as unordered `bulk_write` batches, one per collection.
+
+    A batch is flushed once it holds `max_ops` writes or its oldest write has waited `max_wait_seconds`.
+    Batches are unordered, so only queue writes that give the same result in any order (e.g. `$max`, `$setOnInsert`, or `$set` on separate fields).
+    Needs real pymongo collections, mongomock can't run pymongo's bulk operations (the bot takes `bulk_writes=False` on top of it).
+    """
+
+    def __init__(self, max_ops: int, max_wait_seconds: float):
+        self.max_ops = max_ops
+        self.max_wait_seconds = max_wait_seconds
+        self.written = 0
+        self.flushes = 0
+        self.failed = 0
+        self._pending: Dict[str, Tuple[Collection, List]] = {}
+        self._size = 0
+        self._oldest: Optional[float] = None
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._condition = threading.Condition()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="mongo-bulk-writer", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Flush everything still buffered and stop the writer thread"""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def update_one(self, collection: Collection, filter: dict, update: dict, upsert: bool = True):
+        self._queue(collection, UpdateOne(filter, update, upsert=upsert))
+
+    def replace_one(self, collection: Collection, filter: dict, replacement: dict, upsert: bool = True):
+        self._queue(collection, ReplaceOne(filter, replacement, upsert=upsert))
+
+    def pending(self) -> int:
+        return self._size
+
+    def stats(self) -> dict:
+        return {"written": self.written, "flushes": self.flushes, "failed": self.failed, "pending": self.pending()}
+
+    def _queue(self, collection: Collection, op):
+        with self._condition:
+            self._pending.setdefault(collection.full_name, (collection, []))[1].append(op)
+            self._size += 1
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._is_due():
+                    timeout = None if self._oldest is None else self._oldest + self.max_wait_seconds - time.monotonic()
+                    self._condition.wait(timeout=timeout)
+                if not self._running and not self._pending:
+                    return
+                batches, self._pending, self._size, self._oldest = list(self._pending.values()), {}, 0, None
+            for collection, ops in batches:
+                self._flush(collection, ops)
+
+    def _is_due(self) -> bool:
+        if not self._pending:
+            return False
+        return self._size >= self.max_ops or time.monotonic() - self._oldest >= self.max_wait_seconds
+
+    # noinspection PyBroadException
+    def _flush(self, collection: Collection, ops: List):
+        try:
+            collection.bulk_write(ops, ordered=False)
+        except BulkWriteError as e:
+            # Unordered batches keep going past failed writes, so only the reported ones are lost
+            failed = len(e.details.get("writeErrors", []))
+            self.failed += failed
+            self.written += len(ops) - failed
+            logger.error(f"{failed} of {len(ops)} writes to {collection.name} failed: {e.details.get('writeErrors', [])[:3]}")
+            return
+        except Exception:
+            self.failed += len(ops)
+            logger.exception(f"Failed to write batch of {len(ops)} ops to {collection.name}")
+            return
+
+        self.flushes += 1
+        self.written += len(ops)
@@ -0,0 +1,43 @@
+import datetime
+from typing import Optional
+
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+
+class MongoLease:
+    """A named lease in a mongo collection, held by at most one node until it expires.
+
+    Acquiring an expired lease (or renewing our own) is a single atomic upsert, so two nodes can never both hold it.
+    Lease documents have a TTL index on `expires_at`, so the leases of dead nodes are cleaned up on their own.
+    """
+
+    def __init__(self, collection: Collection, name: str, node_id: str, lease_seconds: float):
+        self.collection = collection
+        self.name = name
+        self.node_id = node_id
+        self.lease_seconds = lease_seconds
+        self.expires_at: Optional[datetime.datetime] = None
+
+    @property
+    def held(self) -> bool:
+        return self.expires_at is not None and self.expires_at > datetime.datetime.now(tz=datetime.timezone.utc)
+
+    def acquire(self) -> bool:
+        """Take the lease if it is free or expired, or extend it if we already hold it. Returns whether we hold it now"""
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        expires_at = now + datetime.timedelta(seconds=self.lease_seconds)
+        try:
+            # If someone else holds a live lease the filter doesn't match, and the upsert runs into the existing _id
+            self.collection.update_one({"_id": self.name, "$or": [{"holder": self.node_id}, {"expires_at": {"$lt": now}}]},
+                                       {"$set": {"holder": self.node_id, "expires_at": expires_at}},
+                                       upsert=True)
+        except DuplicateKeyError:
+            self.expires_at = None
+            return False
+        self.expires_at = expires_at
+        return True
+
+    def release(self):
+        self.collection.delete_one({"_id": self.name, "holder": self.node_id})
+        self.expires_at = None
@@ -0,0 +1,93 @@
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from loguru import logger
+
+# Spotify accepts at most 100 URIs per add-items request
+SPOTIFY_MAX_ADD_ITEMS = 100
+
+
+class PlaylistAddBuffer:
+    """Collects accepted track URIs and adds them to the playlist in batches.
+
+    A batch is flushed once it holds `max_items` URIs or its oldest URI has waited `max_wait_seconds`.
+    Every submitted URI gets a future that only resolves after the batch containing it was written successfully.
+    A URI counts as waiting until `flush_items` returns, so it can't be submitted again while its batch is being written.
+    """
+
+    def __init__(self, flush_items: Callable[[List[str]], Any], max_items: int, max_wait_seconds: float):
+        self.flush_items = flush_items
+        self.max_items = min(max_items, SPOTIFY_MAX_ADD_ITEMS)
+        self.max_wait_seconds = max_wait_seconds
+        self.flushes = 0
+        self._pending: Dict[str, Future] = {}
+        self._in_flight: Set[str] = set()
+        self._oldest: Optional[float] = None
+        self._running = False
+        self._thread: Optional[threading.Thread] = None
+        self._condition = threading.Condition()
+
+    def start(self):
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="playlist-add-flusher", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        self._thread.join()
+
+    def submit(self, uri: str) -> Optional[Future]:
+        """Buffer a URI for the next flush. Returns None if the URI is already waiting to be added, or being added"""
+        with self._condition:
+            if uri in self._pending or uri in self._in_flight:
+                return None
+            future = Future()
+            self._pending[uri] = future
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._condition.notify()
+            return future
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._running and not self._is_due():
+                    timeout = None if self._oldest is None else self._oldest + self.max_wait_seconds - time.monotonic()
+                    self._condition.wait(timeout=timeout)
+                if not self._running and not self._pending:
+                    return
+                batch = dict(list(self._pending.items())[:self.max_items])
+                for uri in batch:
+                    del self._pending[uri]
+                self._in_flight.update(batch)
+                self._oldest = time.monotonic() if self._pending else None
+            try:
+                self._flush(batch)
+            finally:
+                # By now the songs are in the playlist index, or free to be submitted again
+                with self._condition:
+                    self._in_flight.difference_update(batch)
+
+    def _is_due(self) -> bool:
+        if not self._pending:
+            return False
+        return len(self._pending) >= self.max_items or time.monotonic() - self._oldest >= self.max_wait_seconds
+
+    # noinspection PyBroadException
+    def _flush(self, batch: Dict[str, Future]):
+        logger.debug(f"Flushing {len(batch)} songs to playlist")
+        try:
+            self.flush_items(list(batch))
+        except Exception as e:
+            logger.exception(f"Failed to add batch of {len(batch)} songs to playlist")
+            for future in batch.values():
+                future.set_exception(e)
+            return
+
+        self.flushes += 1
+        for future in batch.values():
+            future.set_result(True)
@@ -0,0 +1,125 @@
+import threading
+from typing import Callable, Iterable, Optional, Set
+
+from loguru import logger
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from spotipy import Spotify
+
+
+class PlaylistIndex:
+    """Local set of every track URI in the playlist so membership checks don't need a playlist download.
+
+    The index is fully paginated once, updated in place after each add, and reconciled against the playlist `snapshot_id`.
+    When a mongo collection is given, the index is persisted there so it survives restarts.
+    Spotify calls go through `governed` (e.g. the bot's rate governor), if given.
+    """
+
+    def __init__(self, spotify_client: Spotify, playlist_id: str, collection: Optional[Collection] = None,
+                 governed: Optional[Callable[[Callable], Callable]] = None):
+        self.spotify_client = spotify_client
+        self.governed = governed or (lambda func: func)
+        self.playlist_id = playlist_id
+        self.collection = collection
+        self.snapshot_id: Optional[str] = None
+        self._uris: Set[str] = set()
+        # Tracks this replica saw in the playlist itself, unlike `_uris` which also holds reservations loaded from mongo
+        self._seen_uris: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, uri: str) -> bool:
+        return uri in self._uris
+
+    def __len__(self) -> int:
+        return len(self._uris)
+
+    def load(self):
+        """Load the index from mongo if it is still current, otherwise rebuild it from Spotify"""
+        if not self._load_persisted(self._get_remote_snapshot_id()):
+            self.rebuild()
+
+    def rebuild(self):
+        """Paginate through the whole playlist and replace the local index with its tracks"""
+        # Grab the snapshot first so changes made mid-pagination are caught by the next reconcile
+        snapshot_id = self._get_remote_snapshot_id()
+        uris = set()
+        results = self.governed(self.spotify_client.playlist_items)(self.playlist_id, fields="items(track(uri)),next", limit=100)
+        while results:
+            uris.update(item["track"]["uri"] for item in results["items"] if item.get("track"))
+            results = self.governed(self.spotify_client.next)(results) if results.get("next") else None
+
+        with self._lock:
+            removed, self._seen_uris = self._seen_uris - uris, set(uris)
+            self._uris = uris
+            self.snapshot_id = snapshot_id
+        self._persist_all(removed)
+        logger.debug(f"Indexed {len(uris)} playlist tracks at snapshot {snapshot_id}")
+
+    def add(self, uris: Iterable[str], snapshot_id: Optional[str] = None):
+        """Record tracks that were just added to the playlist"""
+        uris = list(uris)
+        with self._lock:
+            self._uris.update(uris)
+            self._seen_uris.update(uris)
+            if snapshot_id:
+                self.snapshot_id = snapshot_id
+        if self.collection is not None:
+            update = {"$addToSet": {"uris": {"$each": uris}}}
+            if snapshot_id:
+                update["$set"] = {"snapshot_id": snapshot_id}
+            self.collection.update_one({"_id": self.playlist_id}, update, upsert=True)
+
+    def reserve(self, uri: str) -> bool:
+        """Atomically claim a track in the persisted index before adding it, so replicas sharing the playlist never add it twice.
+        Returns False if the track is already in the playlist or another replica is adding it"""
+        if uri in self._uris:
+            return False
+        if self.collection is None:
+            return True
+        try:
+            # The filter misses if the track is already there, and the upsert then runs into the existing _id
+            self.collection.update_one({"_id": self.playlist_id, "uris": {"$ne": uri}}, {"$push": {"uris": uri}}, upsert=True)
+        except DuplicateKeyError:
+            return False
+        return True
+
+    def unreserve(self, uris: Iterable[str]):
+        """Give back reserved tracks that couldn't be added"""
+        if self.collection is not None:
+            self.collection.update_one({"_id": self.playlist_id}, {"$pull": {"uris": {"$in": list(uris)}}})
+
+    def reconcile(self):
+        """Rebuild the index only if the playlist was changed outside the bot.
+        Changes another replica made are already in the persisted index, so those are just loaded from there"""
+        remote_snapshot_id = self._get_remote_snapshot_id()
+        if remote_snapshot_id == self.snapshot_id or self._load_persisted(remote_snapshot_id):
+            return
+        logger.info(f"Playlist snapshot changed ({self.snapshot_id} -> {remote_snapshot_id}), rebuilding index")
+        self.rebuild()
+
+    def _get_remote_snapshot_id(self) -> str:
+        return self.governed(self.spotify_client.playlist)(self.playlist_id, fields="snapshot_id")["snapshot_id"]
+
+    def _load_persisted(self, snapshot_id: str) -> bool:
+        """Take over the persisted index if it is at `snapshot_id`. Returns False if there is none or it is out of date"""
+        if self.collection is None:
+            return False
+        doc = self.collection.find_one({"_id": self.playlist_id})
+        if not doc or doc.get("snapshot_id") != snapshot_id:
+            return False
+        with self._lock:
+            self._uris = set(doc.get("uris", []))
+            self.snapshot_id = snapshot_id
+        logger.debug(f"Loaded {len(self._uris)} playlist tracks at snapshot {snapshot_id} from mongo")
+        return True
+
+    def _persist_all(self, removed: Set[str]):
+        if self.collection is None:
+            return
+        # Merged into the persisted index instead of replacing it, so other replicas' reservations survive a rebuild.
+        # Only tracks this replica saw and that have since left the playlist are dropped
+        if removed:
+            self.collection.update_one({"_id": self.playlist_id}, {"$pull": {"uris": {"$in": list(removed)}}})
+        self.collection.update_one({"_id": self.playlist_id},
+                                   {"$addToSet": {"uris": {"$each": list(self._uris)}}, "$set": {"snapshot_id": self.snapshot_id}},
+                                   upsert=True)
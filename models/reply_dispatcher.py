@@ -0,0 +1,177 @@
+import itertools
+import queue
+import sys
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+import tweepy
+from loguru import logger
+from tweepy import Tweet
+
+from util import helpers
+from util.rate_governor import RateGovernor
+
+OUTCOME_ADDED = "added"
+OUTCOME_ALREADY_IN_PLAYLIST = "already_in_playlist"
+OUTCOME_ALREADY_SUBMITTED = "already_submitted"
+
+# Client errors that won't go away by sending the same reply again
+PERMANENT_ERRORS = (tweepy.BadRequest, tweepy.Unauthorized, tweepy.Forbidden, tweepy.NotFound)
+
+
+class ReplyDispatcher:
+    """Sends reply tweets from background threads so the reply pipeline never waits on twitter writes.
+
+    Each user gets at most one reply per outcome per scope (e.g. campaign) per day, so spamming a thread doesn't spend our tweet budget.
+    Messages are format strings, filled in with the `message_args` of each dispatch.
+    When the budget is tight, low-priority notices are held back for up to `max_delay_seconds` and then dropped.
+    Failed sends are retried with exponential backoff.
+    `on_finished` is called once a reply is done with, whether it was sent, deduplicated, dropped or given up on.
+    `on_auth_error` is called when twitter rejects our credentials, e.g. to refresh them before the next send.
+    """
+
+    def __init__(self, send: Callable[[Tweet, str, int], None], messages: Dict[str, Tuple[str, int]], rate_governor: RateGovernor,
+                 budget_endpoint: str, num_senders: int, max_retries: int, max_delay_seconds: float, low_budget_watermark: float,
+                 low_priority: int, on_finished: Optional[Callable[[Tweet, str], None]] = None,
+                 on_auth_error: Optional[Callable[[], None]] = None):
+        self.send = send
+        self.messages = messages
+        self.rate_governor = rate_governor
+        self.budget_endpoint = budget_endpoint
+        self.num_senders = num_senders
+        self.max_retries = max_retries
+        self.max_delay_seconds = max_delay_seconds
+        self.low_budget_watermark = low_budget_watermark
+        self.low_priority = low_priority
+        self.on_finished = on_finished
+        self.on_auth_error = on_auth_error
+        self.sent = 0
+        self.deduplicated = 0
+        self.delayed = 0
+        self.dropped = 0
+        self.retried = 0
+        self.failed = 0
+        self._day: Optional[str] = None
+        self._seen: Set[Tuple[str, str, str]] = set()
+        self._queue: queue.PriorityQueue = queue.PriorityQueue()
+        self._sequence = itertools.count()
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i in range(self.num_senders):
+            thread = threading.Thread(target=self._run, name=f"reply-sender-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for _ in self._threads:
+            self._queue.put((sys.maxsize, next(self._sequence), None))
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def dispatch(self, reply: Tweet, outcome: str, scope: str = "", message_args: Optional[dict] = None) -> bool:
+        """Queue the reply for an outcome. Returns False if the user already got this reply in this scope today"""
+        key, day = (str(reply.author_id), scope, outcome), helpers.current_day()
+        with self._lock:
+            if day != self._day:
+                self._day = day
+                self._seen.clear()
+            if key in self._seen:
+                self.deduplicated += 1
+                logger.debug(f"Already replied {outcome} to {reply.author_id} today, skipping reply to {reply.id}")
+                deduplicated = True
+            else:
+                self._seen.add(key)
+                deduplicated = False
+
+        if deduplicated:
+            self._finish(reply, outcome)
+            return False
+        self._put({"reply": reply, "outcome": outcome, "message_args": message_args or {}, "attempts": 0, "queued_at": time.monotonic()})
+        return True
+
+    def pending(self) -> int:
+        return self._queue.qsize()
+
+    def stats(self) -> dict:
+        return {"sent": self.sent, "deduplicated": self.deduplicated, "delayed": self.delayed, "dropped": self.dropped,
+                "retried": self.retried, "failed": self.failed, "pending": self.pending()}
+
+    def _put(self, item: dict):
+        priority = self.messages[item["outcome"]][1]
+        self._queue.put((priority, next(self._sequence), item))
+
+    def _put_later(self, item: dict, delay: float):
+        timer = threading.Timer(delay, self._put, args=(item,))
+        timer.daemon = True
+        timer.start()
+
+    # noinspection PyBroadException
+    def _run(self):
+        while True:
+            _, _, item = self._queue.get()
+            if item is None:
+                break
+
+            reply, outcome = item["reply"], item["outcome"]
+            message, priority = self.messages[outcome]
+            message = message.format(**item["message_args"])
+
+            # Hold low-priority notices back while the write budget is tight, and give up on them once they're stale
+            if priority >= self.low_priority and self.rate_governor.available(self.budget_endpoint) < self.low_budget_watermark:
+                if time.monotonic() - item["queued_at"] >= self.max_delay_seconds:
+                    with self._lock:
+                        self.dropped += 1
+                    logger.debug(f"Dropped {outcome} reply to {reply.id}, tweet budget is tight")
+                    self._finish(reply, outcome)
+                else:
+                    with self._lock:
+                        self.delayed += 1
+                    self._put_later(item, min(5.0, self.max_delay_seconds))
+                continue
+
+            try:
+                self.send(reply, message, priority)
+                with self._lock:
+                    self.sent += 1
+                self._finish(reply, outcome)
+            except PERMANENT_ERRORS as e:
+                with self._lock:
+                    self.failed += 1
+                logger.exception(f"Twitter rejected {outcome} reply to {reply.id}")
+                if isinstance(e, tweepy.Unauthorized):
+                    self._auth_error()
+                self._finish(reply, outcome)
+            except Exception:
+                item["attempts"] += 1
+                if item["attempts"] > self.max_retries:
+                    with self._lock:
+                        self.failed += 1
+                    logger.exception(f"Giving up on {outcome} reply to {reply.id} after {self.max_retries} retries")
+                    self._finish(reply, outcome)
+                else:
+                    with self._lock:
+                        self.retried += 1
+                    logger.warning(f"Failed to send {outcome} reply to {reply.id}, retrying (attempt {item['attempts']})")
+                    self._put_later(item, 2 ** item["attempts"])
+
+    # noinspection PyBroadException
+    def _auth_error(self):
+        if self.on_auth_error is None:
+            return
+        try:
+            self.on_auth_error()
+        except Exception:
+            logger.exception("Failed to handle rejected twitter credentials")
+
+    # noinspection PyBroadException
+    def _finish(self, reply: Tweet, outcome: str):
+        if self.on_finished is None:
+            return
+        try:
+            self.on_finished(reply, outcome)
+        except Exception:
+            logger.exception(f"Failed to record finished {outcome} reply to {reply.id}")
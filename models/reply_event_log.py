@@ -0,0 +1,109 @@
+import datetime
+import json
+import os
+import threading
+from typing import Dict, Iterator, List, Optional, TextIO
+
+from loguru import logger
+from tweepy import Tweet
+
+from util import helpers
+
+STAGE_RECEIVED = "received"
+STAGE_PROCESSED = "processed"
+STAGE_ADDED = "added"
+STAGE_REPLIED = "replied"
+STAGE_FAILED = "failed"
+STAGE_QUEUED = "queued"
+# A reply is done once it was answered, given up on, or handed to the cluster's work queue (which is durable itself)
+FINAL_STAGES = {STAGE_REPLIED, STAGE_FAILED, STAGE_QUEUED}
+
+
+class ReplyEventLog:
+    """Write-ahead log of the reply stream, one append-only JSONL file per day in `directory`.
+
+    Every direct reply is appended (and fsynced) before it is processed, followed by a marker for every pipeline stage it
+    gets through. On startup, `unfinished` returns the replies of the last days that never reached a final stage so they can be
+    resumed from their last stage. Markers are only flushed, not fsynced: losing one just means a stage is redone on replay.
+    Day files older than `retention_days` are deleted by `prune`. The files double as recordings for the offline replay benchmark.
+    """
+
+    def __init__(self, directory: str, fsync: bool = True, retention_days: int = 7):
+        self.directory = directory
+        self.fsync = fsync
+        self.retention_days = retention_days
+        self.appended = 0
+        self._day: Optional[str] = None
+        self._file: Optional[TextIO] = None
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def received(self, campaign: str, reply: Tweet):
+        self._append({"stage": STAGE_RECEIVED, "id": str(reply.id), "campaign": campaign, "tweet": reply.data}, sync=self.fsync)
+
+    def mark(self, reply_id, stage: str, **fields):
+        self._append({"stage": stage, "id": str(reply_id), **fields}, sync=False)
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file, self._day = None, None
+
+    def unfinished(self, days: int = 2) -> List[dict]:
+        """Replies received in the last `days` day files that never reached a final stage, oldest first. Each comes with its
+        `campaign`, raw `tweet`, the bot `day` it was received on and the `stages` it did reach, mapped to the fields of their markers"""
+        entries: Dict[str, dict] = {}
+        for path in self.day_files()[-days:]:
+            day = os.path.basename(path)[:-len(".jsonl")]
+            for record in self.read(path):
+                if record["stage"] == STAGE_RECEIVED:
+                    entries.setdefault(record["id"], {"campaign": record["campaign"], "tweet": record["tweet"], "day": day, "stages": {}})
+                elif record["id"] in entries:
+                    entries[record["id"]]["stages"][record["stage"]] = record
+        return [entry for entry in entries.values() if not FINAL_STAGES & entry["stages"].keys()]
+
+    def day_files(self) -> List[str]:
+        return sorted(os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".jsonl"))
+
+    def prune(self):
+        cutoff = (datetime.date.fromisoformat(helpers.current_day()) - datetime.timedelta(days=self.retention_days)).isoformat()
+        for path in self.day_files():
+            if os.path.basename(path)[:-len(".jsonl")] < cutoff:
+                os.remove(path)
+                logger.debug(f"Deleted old reply log {path}")
+
+    @staticmethod
+    def read(path: str) -> Iterator[dict]:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError:
+                    # A crash mid-write leaves a torn line behind, the next run starts a fresh line after it
+                    logger.warning(f"Skipping torn record in {path}")
+
+    def _append(self, record: dict, sync: bool):
+        line = json.dumps({**record, "at": datetime.datetime.now(tz=datetime.timezone.utc).isoformat()}, default=str) + "\n"
+        with self._lock:
+            day = helpers.current_day()
+            if day != self._day:
+                if self._file is not None:
+                    self._file.close()
+                self._file = self._open(os.path.join(self.directory, f"{day}.jsonl"))
+                self._day = day
+            self._file.write(line)
+            self._file.flush()
+            if sync:
+                os.fsync(self._file.fileno())
+            self.appended += 1
+
+    @staticmethod
+    def _open(path: str) -> TextIO:
+        # Start on a fresh line if the last write before a crash was torn, so it doesn't swallow the next record
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, "rb+") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    f.write(b"\n")
+        return open(path, "a", encoding="utf-8")
@@ -0,0 +1,133 @@
+import threading
+from typing import Dict, Optional
+
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+
+from models.mongo_bulk_writer import MongoBulkWriter
+from util import helpers
+
+STATUS_PENDING = "pending"
+STATUS_ADDED = "added"
+STATUS_BACKFILLED = "backfilled"
+STATUS_RELEASED = "released"
+
+
+class ReplyLedger:
+    """Daily record of which users already suggested a song to a campaign, backed by a mongo collection with a unique
+    (campaign, date, author_id) index.
+
+    Claims are plain inserts, so the unique index keeps the one-song-per-day rule correct across bot processes.
+    A released slot stays behind as a `released` entry, which a new claim takes over but a backfilled record of the same reply can't.
+    An in-process cache of today's entries sits in front of mongo. Without a collection the ledger is in-memory only.
+    Claims and releases are always written right away. Status updates and backfilled records go through the bulk `writer` when one is given.
+    """
+
+    def __init__(self, collection: Optional[Collection] = None, writer: Optional[MongoBulkWriter] = None, campaign: str = "default"):
+        self.collection = collection
+        self.campaign = campaign
+        self.writer = writer
+        self._day: Optional[str] = None
+        self._entries: Dict[str, dict] = {}
+        self._lock = threading.Lock()
+
+    def get(self, author_id) -> Optional[dict]:
+        """Return the user's claimed ledger entry for today, reading through to mongo on a cache miss. Released entries don't count"""
+        author_id, day = str(author_id), helpers.current_day()
+        with self._lock:
+            entries = self._entries_for(day)
+            if author_id in entries:
+                return self._claimed(entries[author_id])
+
+        if self.collection is None:
+            return None
+        entry = self.collection.find_one(self._key(day, author_id), {"_id": False})
+        if entry:
+            with self._lock:
+                self._entries_for(day)[author_id] = entry
+        return self._claimed(entry)
+
+    def claim(self, author_id, reply_id, suggestion: str) -> bool:
+        """Atomically take the user's suggestion slot for today. Returns False if they already have one.
+        Claiming again for the same reply succeeds, so a reply replayed after a restart picks up its own claim"""
+        if (existing := self.get(author_id)) is not None:
+            return existing.get("reply_id") == str(reply_id)
+
+        author_id, day = str(author_id), helpers.current_day()
+        entry = {**self._key(day, author_id), "reply_id": str(reply_id), "suggestion": suggestion, "song_uri": None,
+                 "status": STATUS_PENDING}
+        with self._lock:
+            entries = self._entries_for(day)
+            if self._claimed(entries.get(author_id)) is not None:
+                return entries[author_id].get("reply_id") == str(reply_id)
+            entries[author_id] = entry
+
+        if self.collection is not None:
+            try:
+                # Takes over a released entry, otherwise the upsert runs into the existing claim on the unique index
+                self.collection.update_one({**self._key(day, author_id), "status": STATUS_RELEASED}, {"$set": entry}, upsert=True)
+            except DuplicateKeyError:
+                # Another process claimed this user first, so cache its entry instead of ours
+                existing = self.collection.find_one(self._key(day, author_id), {"_id": False})
+                with self._lock:
+                    if existing:
+                        self._entries_for(day)[author_id] = existing
+                    else:
+                        self._entries_for(day).pop(author_id, None)
+                return self._claimed(existing) is not None and existing.get("reply_id") == str(reply_id)
+        return True
+
+    def update(self, author_id, reply_id, **fields):
+        """Set fields (e.g. status, song_uri) on the user's entry for today, as long as it is still the one `reply_id` claimed"""
+        author_id, day = str(author_id), helpers.current_day()
+        with self._lock:
+            entry = self._claimed(self._entries_for(day).get(author_id))
+            if entry is not None and entry.get("reply_id") == str(reply_id):
+                entry.update(fields)
+        # Never upserts and only matches the claiming reply's unreleased entry, so a buffered update that lands after a `release` can
+        # neither bring the entry back nor change the entry of another reply that claimed the slot since
+        self._update_one({**self._key(day, author_id), "reply_id": str(reply_id), "status": {"$ne": STATUS_RELEASED}}, {"$set": fields},
+                         upsert=False)
+
+    def release(self, author_id, reply_id):
+        """Give the user their suggestion slot back, e.g. when their song couldn't be added. Only the reply that claimed it can"""
+        author_id, day = str(author_id), helpers.current_day()
+        with self._lock:
+            entry = self._entries_for(day).get(author_id)
+            if entry is not None and entry.get("reply_id") == str(reply_id):
+                entry["status"] = STATUS_RELEASED
+        if self.collection is not None:
+            self.collection.update_one({**self._key(day, author_id), "reply_id": str(reply_id)}, {"$set": {"status": STATUS_RELEASED}})
+
+    def record(self, author_id, reply_id, suggestion: str, status: str = STATUS_BACKFILLED):
+        """Record a suggestion that was made without going through `claim`, without overwriting an existing entry.
+        A released entry is kept too, so backfilling a reply the stream already handled doesn't take the user's slot again"""
+        author_id, day = str(author_id), helpers.current_day()
+        entry = {**self._key(day, author_id), "reply_id": str(reply_id), "suggestion": suggestion, "song_uri": None,
+                 "status": status}
+        if self.collection is None:
+            with self._lock:
+                self._entries_for(day).setdefault(author_id, entry)
+            return
+        # Not cached, mongo may hold a released entry this process never saw. `get` reads the result through
+        self._update_one(self._key(day, author_id), {"$setOnInsert": entry}, upsert=True)
+
+    @staticmethod
+    def _claimed(entry: Optional[dict]) -> Optional[dict]:
+        return entry if entry is not None and entry.get("status") != STATUS_RELEASED else None
+
+    def _key(self, day: str, author_id: str) -> dict:
+        return {"campaign": self.campaign, "date": day, "author_id": author_id}
+
+    def _update_one(self, filter: dict, update: dict, upsert: bool):
+        if self.writer is not None and self.collection is not None:
+            self.writer.update_one(self.collection, filter, update, upsert=upsert)
+        elif self.collection is not None:
+            self.collection.update_one(filter, update, upsert=upsert)
+
+    def _entries_for(self, day: str) -> Dict[str, dict]:
+        # Drop yesterday's cached entries once the day rolls over. Must be called while holding the lock
+        if day != self._day:
+            self._day = day
+            self._entries = {}
+        return self._entries
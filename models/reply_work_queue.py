@@ -0,0 +1,138 @@
+import datetime
+import threading
+import zlib
+from typing import Callable, Optional, Set
+
+from loguru import logger
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.collection import Collection
+from pymongo.errors import DuplicateKeyError
+from tweepy import Tweet
+
+QUEUED = "queued"
+PROCESSING = "processing"
+FAILED = "failed"
+
+
+class ReplyWorkQueue:
+    """Mongo-backed queue that hands streamed replies from the leader to whichever replicas own their partition.
+
+    Replies are partitioned by author, and a replica only claims replies from the partitions it owns, oldest first, so every
+    reply from the same user is still handled in order. Claims are atomic (`find_one_and_update`), and a claim that isn't
+    completed within `claim_timeout_seconds` (e.g. its replica died) is picked up again by the partition's next owner.
+    Replies that used up their attempts are parked as failed, with a `failed_at` that the collection's TTL index expires them by.
+    """
+
+    def __init__(self, collection: Collection, node_id: str, num_partitions: int, claim_timeout_seconds: float,
+                 max_attempts: int, poll_seconds: float):
+        self.collection = collection
+        self.node_id = node_id
+        self.num_partitions = num_partitions
+        self.claim_timeout_seconds = claim_timeout_seconds
+        self.max_attempts = max_attempts
+        self.poll_seconds = poll_seconds
+        self.enqueued = 0
+        self.claimed = 0
+        self.completed = 0
+        self.retried = 0
+        self.requeued = 0
+        self.failed = 0
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def partition_for(self, author_id) -> int:
+        # Stable across processes, unlike `hash()`
+        return zlib.crc32(str(author_id).encode()) % self.num_partitions
+
+    def enqueue(self, campaign: str, reply: Tweet) -> bool:
+        """Queue a streamed reply. Returns False if it was already queued, e.g. by a leader that lost its lease mid-stream"""
+        try:
+            self.collection.insert_one({"_id": str(reply.id),
+                                        "seq": int(reply.id),
+                                        "campaign": campaign,
+                                        "partition": self.partition_for(reply.author_id),
+                                        "tweet": reply.data,
+                                        "status": QUEUED,
+                                        "attempts": 0,
+                                        "enqueued_at": datetime.datetime.now(tz=datetime.timezone.utc)})
+        except DuplicateKeyError:
+            return False
+        self.enqueued += 1
+        return True
+
+    def claim(self, partitions: Set[int]) -> Optional[dict]:
+        """Claim the oldest reply in the given partitions that is queued or whose claim timed out"""
+        if not partitions:
+            return None
+        now = datetime.datetime.now(tz=datetime.timezone.utc)
+        timed_out = now - datetime.timedelta(seconds=self.claim_timeout_seconds)
+        doc = self.collection.find_one_and_update(
+            {"partition": {"$in": sorted(partitions)},
+             "$or": [{"status": QUEUED}, {"status": PROCESSING, "claimed_at": {"$lt": timed_out}}]},
+            {"$set": {"status": PROCESSING, "claimed_by": self.node_id, "claimed_at": now}, "$inc": {"attempts": 1}},
+            sort=[("seq", ASCENDING)],
+            return_document=ReturnDocument.AFTER)
+        if doc is not None:
+            self.claimed += 1
+        return doc
+
+    def complete(self, reply_id):
+        self.collection.delete_one({"_id": str(reply_id), "claimed_by": self.node_id})
+        self.completed += 1
+
+    def retry(self, reply_id):
+        """Put a reply that failed back in the queue, or park it as failed once it used up its attempts"""
+        doc = self.collection.find_one_and_update({"_id": str(reply_id), "claimed_by": self.node_id},
+                                                  {"$set": {"status": QUEUED}, "$unset": {"claimed_by": "", "claimed_at": ""}},
+                                                  return_document=ReturnDocument.AFTER)
+        if doc is None:
+            return
+        if doc["attempts"] >= self.max_attempts:
+            self.collection.update_one({"_id": doc["_id"]},
+                                       {"$set": {"status": FAILED, "failed_at": datetime.datetime.now(tz=datetime.timezone.utc)}})
+            self.failed += 1
+            logger.error(f"Giving up on reply {reply_id} after {doc['attempts']} attempts")
+        else:
+            self.retried += 1
+
+    def requeue(self, reply_id):
+        """Hand a claimed reply back without counting the attempt, e.g. because this replica had no room for it after all"""
+        self.collection.update_one({"_id": str(reply_id), "claimed_by": self.node_id},
+                                   {"$set": {"status": QUEUED}, "$unset": {"claimed_by": "", "claimed_at": ""}, "$inc": {"attempts": -1}})
+        self.requeued += 1
+
+    def depth(self) -> int:
+        """Replies still waiting for or being worked on by a replica, across every partition"""
+        return self.collection.count_documents({"status": {"$ne": FAILED}})
+
+    def stats(self) -> dict:
+        return {"enqueued": self.enqueued,
+                "claimed": self.claimed,
+                "completed": self.completed,
+                "retried": self.retried,
+                "requeued": self.requeued,
+                "failed": self.failed}
+
+    def start(self, partitions: Callable[[], Set[int]], dispatch: Callable[[dict], bool], has_capacity: Callable[[], bool]):
+        """Keep claiming replies from the partitions this replica owns and pass them to `dispatch` while it has capacity.
+        `dispatch` returns False if it had no room for the reply after all, which hands it back without counting the attempt"""
+        self._thread = threading.Thread(target=self._run, args=(partitions, dispatch, has_capacity), name="reply-work-queue", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._thread.join()
+
+    # noinspection PyBroadException
+    def _run(self, partitions: Callable[[], Set[int]], dispatch: Callable[[dict], bool], has_capacity: Callable[[], bool]):
+        while not self._stopping.is_set():
+            try:
+                doc = self.claim(partitions()) if has_capacity() else None
+                if doc is None:
+                    self._stopping.wait(self.poll_seconds)
+                elif not dispatch(doc):
+                    self.requeue(doc["_id"])
+                    self._stopping.wait(self.poll_seconds)
+            except Exception:
+                logger.exception("Failed to claim reply from the work queue")
+                self._stopping.wait(self.poll_seconds)
@@ -0,0 +1,87 @@
+import queue
+import threading
+from typing import Any, Callable, Hashable, List
+
+from loguru import logger
+
+
+class ReplyWorkerPool:
+    """Fixed set of worker threads that each drain their own bounded queue.
+
+    Items are routed to a worker by key, so every reply from the same user is handled in order by the same worker.
+    When a worker's queue is full, `submit` blocks for up to `put_timeout` seconds (back-pressure) before dropping the item.
+    """
+
+    def __init__(self, handler: Callable[[Any], None], num_workers: int, max_queue_size: int, put_timeout: float):
+        self.handler = handler
+        self.num_workers = num_workers
+        self.put_timeout = put_timeout
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.blocked = 0
+        self.dropped = 0
+        self._queues: List[queue.Queue] = [queue.Queue(maxsize=max_queue_size) for _ in range(num_workers)]
+        self._threads: List[threading.Thread] = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        for i, work_queue in enumerate(self._queues):
+            thread = threading.Thread(target=self._work, args=(work_queue,), name=f"reply-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        logger.debug(f"Started {self.num_workers} reply workers")
+
+    def stop(self):
+        for work_queue in self._queues:
+            work_queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads.clear()
+
+    def submit(self, key: Hashable, item: Any) -> bool:
+        """Queue an item on the worker that owns `key`. Returns False if the item had to be dropped"""
+        work_queue = self._queues[hash(key) % self.num_workers]
+        try:
+            work_queue.put_nowait(item)
+        except queue.Full:
+            with self._lock:
+                self.blocked += 1
+            logger.warning(f"Reply queue is full ({work_queue.qsize()} items), applying back-pressure")
+            try:
+                work_queue.put(item, timeout=self.put_timeout)
+            except queue.Full:
+                with self._lock:
+                    self.dropped += 1
+                logger.error(f"Dropped reply after waiting {self.put_timeout}s for queue space")
+                return False
+
+        with self._lock:
+            self.submitted += 1
+        return True
+
+    def queue_depth(self) -> int:
+        return sum(work_queue.qsize() for work_queue in self._queues)
+
+    def stats(self) -> dict:
+        return {"submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "blocked": self.blocked,
+                "dropped": self.dropped,
+                "queue_depth": self.queue_depth()}
+
+    # noinspection PyBroadException
+    def _work(self, work_queue: queue.Queue):
+        while True:
+            item = work_queue.get()
+            if item is None:
+                break
+            try:
+                self.handler(item)
+                with self._lock:
+                    self.processed += 1
+            except Exception:
+                with self._lock:
+                    self.failed += 1
+                logger.exception(f"Reply worker failed to process item")
@@ -0,0 +1,73 @@
+import datetime
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+from pymongo.collection import Collection
+
+from models.mongo_bulk_writer import MongoBulkWriter
+from util import helpers
+
+
+class SearchCache:
+    """Two-tier cache of resolved Spotify track URIs keyed on the normalized song suggestion.
+
+    The first tier is an in-memory LRU. The optional second tier is a mongo collection whose documents expire through a TTL index.
+    Writes to the second tier go through the bulk `writer` when one is given.
+    """
+
+    def __init__(self, max_size: int, ttl_seconds: int, collection: Optional[Collection] = None, writer: Optional[MongoBulkWriter] = None):
+        self.max_size = max_size
+        self.ttl_seconds = ttl_seconds
+        self.collection = collection
+        self.writer = writer
+        self.hits = 0
+        self.misses = 0
+        self.mongo_hits = 0
+        self._entries: OrderedDict[str, Tuple[str, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, query: str) -> Optional[str]:
+        key = helpers.normalize_query(query)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[1] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self._entries.pop(key, None)
+
+        if self.collection is not None:
+            doc = self.collection.find_one({"_id": key})
+            if doc:
+                self._remember(key, doc["uri"])
+                with self._lock:
+                    self.hits += 1
+                    self.mongo_hits += 1
+                return doc["uri"]
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def set(self, query: str, uri: str):
+        key = helpers.normalize_query(query)
+        self._remember(key, uri)
+        if self.collection is not None:
+            doc = {"_id": key, "uri": uri, "created_at": datetime.datetime.now(tz=datetime.timezone.utc)}
+            if self.writer is not None:
+                self.writer.replace_one(self.collection, {"_id": key}, doc)
+            else:
+                self.collection.replace_one({"_id": key}, doc, upsert=True)
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "mongo_hits": self.mongo_hits, "size": len(self._entries)}
+
+    def _remember(self, key: str, uri: str):
+        with self._lock:
+            self._entries[key] = (uri, time.monotonic() + self.ttl_seconds)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
@@ -0,0 +1,102 @@
+import random
+import threading
+from typing import Callable, Dict, Optional
+
+import tweepy
+from loguru import logger
+
+
+class StreamSupervisor:
+    """Keeps a single filtered stream connected and pointed at the current root tweets, one tagged rule per root tweet.
+
+    Stream rules are diffed against the ones twitter already has, so only changed rules are added or deleted.
+    Rule changes apply to a live connection, so moving to new root tweets never reconnects the stream.
+    When the stream drops, it is reconnected with jittered exponential backoff instead of exiting the process.
+    Rule calls go through `governed` (e.g. the bot's rate governor), if given.
+    """
+
+    def __init__(self, streaming_client: tweepy.StreamingClient, tweet_fields: str, initial_backoff: float, max_backoff: float,
+                 governed: Optional[Callable[[Callable], Callable]] = None):
+        self.streaming_client = streaming_client
+        self.governed = governed or (lambda func: func)
+        self.tweet_fields = tweet_fields
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.rules: Dict[str, str] = {}
+        self.reconnects = 0
+        self._backoff = initial_backoff
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def rule_for(root_tweet_id: str) -> str:
+        # technically `in_reply_to_status_id` is not listed in the documentation officially, but it exists
+        # https://developer.twitter.com/en/blog/product-news/2022/twitter-api-v2-filtered-stream
+        return f"in_reply_to_status_id:{root_tweet_id}"
+
+    def is_alive(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def ensure(self, rules: Dict[str, str]):
+        """Make sure the stream is connected and only watching the given rules (value -> tag). Cheap to call repeatedly"""
+        with self._lock:
+            if rules != self.rules:
+                logger.debug(f"will watch rules: {rules}")
+                self.sync_rules(rules)
+                self.rules = dict(rules)
+
+            if self.is_alive():
+                if not self._stopping.is_set():
+                    logger.debug("Stream is already connected, keeping it")
+                    return
+                # A stop is still winding the old stream down, so wait for it instead of keeping a stream that's about to exit
+                self._thread.join()
+
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="stream-supervisor", daemon=True)
+            self._thread.start()
+
+    def sync_rules(self, desired_rules: Dict[str, str]):
+        """Add and delete only the rules (value -> tag) that differ from the ones twitter already has"""
+        current_rules = {(rule.value, rule.tag): rule.id for rule in self.governed(self.streaming_client.get_rules)().data or []}
+
+        stale_rule_ids = [rule_id for (value, tag), rule_id in current_rules.items() if desired_rules.get(value) != tag]
+        if stale_rule_ids:
+            logger.debug(f"Deleting {len(stale_rule_ids)} stale stream rules")
+            self.governed(self.streaming_client.delete_rules)(stale_rule_ids)
+
+        missing_rules = [tweepy.StreamRule(value, tag) for value, tag in desired_rules.items() if (value, tag) not in current_rules]
+        if missing_rules:
+            logger.debug(f"Adding stream rules: {[rule.value for rule in missing_rules]}")
+            self.governed(self.streaming_client.add_rules)(missing_rules)
+
+    def on_connected(self):
+        """Called by the stream once a connection is established, resets the reconnect backoff"""
+        self._backoff = self.initial_backoff
+
+    def stop(self):
+        self._stopping.set()
+        self.streaming_client.disconnect()
+        if self.is_alive() and threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    # noinspection PyBroadException
+    def _run(self):
+        while not self._stopping.is_set():
+            logger.debug("Starting stream")
+            try:
+                # Ensure we get these fields in the response. Blocks until the stream disconnects
+                self.streaming_client.filter(tweet_fields=self.tweet_fields)
+            except Exception:
+                logger.exception("Stream crashed")
+
+            if self._stopping.is_set():
+                break
+
+            delay = random.uniform(0, self._backoff)
+            self._backoff = min(self._backoff * 2, self.max_backoff)
+            self.reconnects += 1
+            logger.warning(f"Stream disconnected, reconnecting in {delay:.1f}s")
+            self._stopping.wait(delay)
+        logger.info("Stream supervisor stopped")
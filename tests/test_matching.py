@@ -0,0 +1,67 @@
+"""Checks how suggestions are split into title and artist and how search results are ranked against them"""
+import pytest
+
+from util.matching import CONFIDENCE_THRESHOLD, parse_proposal, rank_tracks, score_track, structured_query
+
+
+def track(name: str, *artists: str, popularity: int = 50) -> dict:
+    return {"name": name, "artists": [{"name": artist} for artist in artists], "popularity": popularity}
+
+
+@pytest.mark.parametrize("proposal, expected", [
+    ("Hello - Adele", ("Hello", "Adele")),
+    ("Hello — Adele", ("Hello", "Adele")),
+    ("Hello ~ Adele", ("Hello", "Adele")),
+    ("Hello | Adele", ("Hello", "Adele")),
+    ("Hello : Adele", ("Hello", "Adele")),
+    ("Hello by Adele", ("Hello", "Adele")),
+    ("Hello BY Adele", ("Hello", "Adele")),
+    ("Stand by Me - Ben E. King", ("Stand by Me", "Ben E. King")),
+    ("Drive By - Train", ("Drive By", "Train")),
+    ("Empire State of Mind by Jay-Z", ("Empire State of Mind", "Jay-Z")),
+    ("Hello-Adele", ("Hello", "Adele")),
+])
+def test_parse_proposal_splits_title_and_artist(proposal, expected):
+    assert parse_proposal(proposal) == [expected, expected[::-1]]
+
+
+@pytest.mark.parametrize("proposal", ["Bohemian Rhapsody", "  Bohemian Rhapsody  ", "- Bohemian Rhapsody"])
+def test_parse_proposal_without_artist(proposal):
+    assert parse_proposal(proposal) == [(proposal.strip(), "")]
+
+
+def test_structured_query():
+    assert structured_query("Stand by Me - Ben E. King") == "track:Stand by Me artist:Ben E. King"
+    assert structured_query("Bohemian Rhapsody") == "track:Bohemian Rhapsody"
+
+
+def test_score_track_prefers_exact_match():
+    exact = score_track("Hello", "Adele", track("Hello", "Adele"))
+    assert exact >= CONFIDENCE_THRESHOLD
+    assert exact > score_track("Hello", "Adele", track("Hello", "Lionel Richie"))
+    assert exact > score_track("Hello", "Adele", track("Rolling in the Deep", "Adele"))
+    assert score_track("Hello", "Adele", track("Yesterday", "The Beatles")) < CONFIDENCE_THRESHOLD
+
+
+def test_score_track_without_artist_relies_on_title():
+    assert score_track("Bohemian Rhapsody", "", track("Bohemian Rhapsody", "Queen")) >= CONFIDENCE_THRESHOLD
+    assert score_track("Bohemian Rhapsody", "", track("Another One Bites the Dust", "Queen")) < CONFIDENCE_THRESHOLD
+
+
+def test_score_track_uses_popularity_as_tiebreaker():
+    assert score_track("Hello", "Adele", track("Hello", "Adele", popularity=90)) > \
+           score_track("Hello", "Adele", track("Hello", "Adele", popularity=10))
+
+
+def test_rank_tracks_orders_best_match_first():
+    tracks = [track("Stand by Me", "Florence + The Machine", popularity=60), track("Me", "Taylor Swift", popularity=80),
+              track("Stand by Me", "Ben E. King", popularity=70)]
+    ranked = rank_tracks("Stand by Me - Ben E. King", tracks)
+
+    assert [scored_track for _, scored_track in ranked][0] is tracks[2]
+    assert [score for score, _ in ranked] == sorted((score for score, _ in ranked), reverse=True)
+
+
+def test_rank_tracks_accepts_artist_first():
+    tracks = [track("Adele", "Someone Else"), track("Hello", "Adele")]
+    assert rank_tracks("Adele - Hello", tracks)[0][1] is tracks[1]
@@ -0,0 +1,42 @@
+"""Runs the offline reply-pipeline benchmark on a small stream and checks it against the baselines the pipeline was tuned to"""
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from benchmarks.reply_pipeline import parse_args, run, synthetic_replies
+
+# Every reply costs at most one search and one reply tweet, and searches are shared through the alias index and search cache
+MAX_API_CALLS_PER_REPLY = 1.5
+# Concurrent workers can both miss on a song neither of them has resolved yet
+MAX_SEARCHES_PER_DISTINCT_SONG = 1.1
+# Replies wait for their song's playlist batch, so this only catches stalls, not regressions of a few milliseconds
+MAX_P99_MS = 10_000
+
+
+def distinct_songs(args) -> int:
+    campaigns = [SimpleNamespace(name=f"campaign{i}", root_tweet_id=str(i)) for i in range(args.campaigns)]
+    return len({re.search(r"song\d+", response.data.text).group() for response in synthetic_replies(args, "playlistter", campaigns)})
+
+
+@pytest.mark.parametrize("argv", [[], ["--campaigns", "3"], ["--mongo"]], ids=["default", "campaigns", "mongo"])
+def test_reply_pipeline_baseline(argv):
+    if "--mongo" in argv:
+        pytest.importorskip("mongomock")
+    args = parse_args(["--replies", "300", "--latency-ms", "5", *argv])
+    results = run(args)
+
+    workers = results["reply_workers"]
+    assert workers["processed"] == args.replies
+    assert workers["failed"] == workers["dropped"] == 0
+
+    # Every reply is answered, apart from the ones deduplicated per user, campaign and outcome
+    dispatcher = results["reply_dispatcher"]
+    assert dispatcher["failed"] == dispatcher["dropped"] == 0
+    assert dispatcher["sent"] + dispatcher["deduplicated"] == args.replies
+    assert results["replies_sent"] == dispatcher["sent"]
+
+    assert results["api_calls_per_reply"] <= MAX_API_CALLS_PER_REPLY
+    assert results["api_calls"]["search"] <= distinct_songs(args) * MAX_SEARCHES_PER_DISTINCT_SONG
+    assert results["api_calls"]["playlist_add_items"] == results["playlist_flushes"] < args.replies / 10
+    assert results["p99_ms"] <= MAX_P99_MS
@@ -0,0 +1,72 @@
+"""Inspect and correct the song aliases the bot learned.
+
+    python -m util.alias_admin list --max-confidence 0.8
+    python -m util.alias_admin show "Blinding Lights - The Weeknd"
+    python -m util.alias_admin set "Blinding Lights - The Weeknd" spotify:track:0VjIjW4GlUZAMYd2vXMi3b
+    python -m util.alias_admin delete "Blinding Lights - The Weeknd"
+    python -m util.alias_admin delete --uri spotify:track:<wrong track>
+
+Running bots pick up changes on their next alias reload (`alias_reload_seconds`).
+"""
+import argparse
+from typing import List, Optional
+
+from api import mongo_client
+from models.alias_index import AliasIndex, signature
+from util import config
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    list_parser = commands.add_parser("list", help="list aliases, least confident first")
+    list_parser.add_argument("--max-confidence", type=float, default=1.0, help="only list aliases at or below this confidence")
+    list_parser.add_argument("--uri", help="only list aliases of this track")
+    list_parser.add_argument("--limit", type=int, default=50)
+
+    show_parser = commands.add_parser("show", help="show the alias a suggestion resolves to")
+    show_parser.add_argument("text")
+
+    set_parser = commands.add_parser("set", help="pin a suggestion to a track, learning never overrides pinned aliases")
+    set_parser.add_argument("text")
+    set_parser.add_argument("uri")
+
+    delete_parser = commands.add_parser("delete", help="forget the alias of a suggestion, or every alias of a track")
+    delete_target = delete_parser.add_mutually_exclusive_group(required=True)
+    delete_target.add_argument("text", nargs="?")
+    delete_target.add_argument("--uri")
+    return parser.parse_args(argv)
+
+
+def format_alias(doc: dict) -> str:
+    return f"{doc['confidence']:.2f}  {doc['source']:<7}  {doc['uri']}  {doc['_id']!r} (e.g. {doc.get('text')!r})"
+
+
+def main(args: argparse.Namespace):
+    mongo = mongo_client.login(username=config.MONGO_USER, password=config.MONGO_PASSWORD, hostname=config.MONGO_HOST)
+    collection = mongo_client.get_database(mongo, config.MONGO_DB)["song_aliases"]
+    alias_index = AliasIndex(min_confidence=config.ALIAS_MIN_CONFIDENCE, reload_seconds=config.ALIAS_RELOAD_SECONDS, collection=collection)
+
+    if args.command == "list":
+        query = {"confidence": {"$lte": args.max_confidence}}
+        if args.uri:
+            query["uri"] = args.uri
+        for doc in collection.find(query).sort("confidence", 1).limit(args.limit):
+            print(format_alias(doc))
+    elif args.command == "show":
+        doc = collection.find_one({"_id": signature(args.text)})
+        if doc is None:
+            print(f"No alias for {signature(args.text)!r}")
+        else:
+            used = doc["confidence"] >= config.ALIAS_MIN_CONFIDENCE
+            print(f"{format_alias(doc)}{'' if used else f'  [unused, below {config.ALIAS_MIN_CONFIDENCE}]'}")
+    elif args.command == "set":
+        alias_index.pin(args.text, args.uri)
+        print(f"Pinned {signature(args.text)!r} to {args.uri}")
+    elif args.command == "delete":
+        print(f"Deleted {alias_index.forget(text=args.text, uri=args.uri)} alias(es)")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -1,6 +1,10 @@
 # Twitter configs
+import os
+import socket
+from functools import lru_cache
+
 import spotify_token
-from decouple import config
+from decouple import Csv, config
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -14,12 +18,92 @@ TWITTER_BEARER_TOKEN = config("twitter_bearer_token")
 SPOTIFY_CLIENT_ID = config("spotify_client_id")
 SPOTIFY_CLIENT_SECRET = config("spotify_client_secret")
 SPOTIFY_PLAYLIST_ID = config("spotify_playlist_id")
+# Extra daily threads next to the default one, as comma separated `name:playlist_id` pairs
+CAMPAIGNS = dict(pair.split(":", 1) for pair in config("campaigns", default="", cast=Csv()))
 SPOTIFY_DC = config("spotify_dc")
 SPOTIFY_KEY = config("spotify_key")
-SPOTIFY_PERMA_TOKEN = spotify_token.start_session(dc=SPOTIFY_DC, key=SPOTIFY_KEY)[0]
 
 # Mongo Configs
 MONGO_HOST = config("mongo_host")
 MONGO_PORT = config("mongo_port")
 MONGO_USER = config("mongo_user")
-MONGO_PASSWORD = config("mongo_password")
\ No newline at end of file
+MONGO_PASSWORD = config("mongo_password")
+MONGO_DB = config("mongo_db", default="playlistter")
+MONGO_MAX_POOL_SIZE = config("mongo_max_pool_size", default=50, cast=int)
+MONGO_MIN_POOL_SIZE = config("mongo_min_pool_size", default=2, cast=int)
+MONGO_MAX_IDLE_SECONDS = config("mongo_max_idle_seconds", default=300.0, cast=float)
+MONGO_SERVER_SELECTION_TIMEOUT_SECONDS = config("mongo_server_selection_timeout_seconds", default=5.0, cast=float)
+MONGO_CONNECT_TIMEOUT_SECONDS = config("mongo_connect_timeout_seconds", default=5.0, cast=float)
+MONGO_SOCKET_TIMEOUT_SECONDS = config("mongo_socket_timeout_seconds", default=10.0, cast=float)
+MONGO_WRITE_CONCERN = config("mongo_write_concern", default="majority")
+MONGO_BULK_BATCH_SIZE = config("mongo_bulk_batch_size", default=500, cast=int)
+MONGO_BULK_WAIT_SECONDS = config("mongo_bulk_wait_seconds", default=1.0, cast=float)
+
+# Playlist index configs
+PLAYLIST_RECONCILE_MINUTES = config("playlist_reconcile_minutes", default=15, cast=int)
+
+# Search cache configs
+SEARCH_CACHE_SIZE = config("search_cache_size", default=1024, cast=int)
+SEARCH_CACHE_TTL_SECONDS = config("search_cache_ttl_seconds", default=7 * 24 * 60 * 60, cast=int)
+
+# Alias configs: learned aliases below `alias_min_confidence` are kept for review but never used
+ALIAS_MIN_CONFIDENCE = config("alias_min_confidence", default=0.75, cast=float)
+ALIAS_RELOAD_SECONDS = config("alias_reload_seconds", default=300.0, cast=float)
+
+# Reply worker configs
+REPLY_WORKERS = config("reply_workers", default=4, cast=int)
+REPLY_QUEUE_SIZE = config("reply_queue_size", default=100, cast=int)
+REPLY_ENQUEUE_TIMEOUT_SECONDS = config("reply_enqueue_timeout_seconds", default=5.0, cast=float)
+REPLY_SENDERS = config("reply_senders", default=2, cast=int)
+REPLY_SEND_RETRIES = config("reply_send_retries", default=3, cast=int)
+REPLY_LOW_PRIORITY_MAX_DELAY_SECONDS = config("reply_low_priority_max_delay_seconds", default=60.0, cast=float)
+REPLY_LOW_BUDGET_WATERMARK = config("reply_low_budget_watermark", default=0.3, cast=float)
+
+# Playlist batching configs
+PLAYLIST_BATCH_SIZE = config("playlist_batch_size", default=50, cast=int)
+PLAYLIST_BATCH_WAIT_SECONDS = config("playlist_batch_wait_seconds", default=2.0, cast=float)
+
+# Stream configs
+STREAM_RECONNECT_BACKOFF_SECONDS = config("stream_reconnect_backoff_seconds", default=1.0, cast=float)
+STREAM_RECONNECT_MAX_BACKOFF_SECONDS = config("stream_reconnect_max_backoff_seconds", default=300.0, cast=float)
+
+
+# Reply log configs: `reply_log_dir=` (empty) turns the write-ahead log of the reply stream off
+REPLY_LOG_DIR = config("reply_log_dir", default="reply_log")
+REPLY_LOG_FSYNC = config("reply_log_fsync", default=True, cast=bool)
+REPLY_LOG_REPLAY_DAYS = config("reply_log_replay_days", default=2, cast=int)
+REPLY_LOG_RETENTION_DAYS = config("reply_log_retention_days", default=7, cast=int)
+
+# Engine configs: `threaded` runs replies on a worker pool, `asyncio` runs them as asyncio tasks
+ENGINE = config("engine", default="threaded")
+ASYNC_TWITTER_CONCURRENCY = config("async_twitter_concurrency", default=4, cast=int)
+ASYNC_SPOTIFY_CONCURRENCY = config("async_spotify_concurrency", default=8, cast=int)
+ASYNC_MONGO_CONCURRENCY = config("async_mongo_concurrency", default=16, cast=int)
+
+# Metrics configs: `metrics_port=0` turns the `/metrics` endpoint off
+METRICS_HOST = config("metrics_host", default="127.0.0.1")
+METRICS_PORT = config("metrics_port", default=9108, cast=int)
+METRICS_SUMMARY_MINUTES = config("metrics_summary_minutes", default=5, cast=int)
+
+# Cluster configs: with `cluster_mode` on, replicas elect a leader for the scheduler and stream and share replies through mongo
+CLUSTER_MODE = config("cluster_mode", default=False, cast=bool)
+CLUSTER_NODE_ID = config("cluster_node_id", default=f"{socket.gethostname()}-{os.getpid()}")
+CLUSTER_LEASE_SECONDS = config("cluster_lease_seconds", default=15.0, cast=float)
+CLUSTER_PARTITIONS = config("cluster_partitions", default=16, cast=int)
+WORK_QUEUE_CLAIM_TIMEOUT_SECONDS = config("work_queue_claim_timeout_seconds", default=120.0, cast=float)
+WORK_QUEUE_MAX_ATTEMPTS = config("work_queue_max_attempts", default=3, cast=int)
+WORK_QUEUE_POLL_SECONDS = config("work_queue_poll_seconds", default=0.5, cast=float)
+WORK_QUEUE_FAILED_TTL_SECONDS = config("work_queue_failed_ttl_seconds", default=7 * 24 * 60 * 60, cast=int)
+
+
+@lru_cache(maxsize=None)
+def get_spotify_perma_token() -> str:
+    """Exchange the spotify cookies for an access token. Only done on first use since it's a network round-trip"""
+    return spotify_token.start_session(dc=SPOTIFY_DC, key=SPOTIFY_KEY)[0]
+
+
+def __getattr__(name: str):
+    # Keep `config.SPOTIFY_PERMA_TOKEN` working without paying for the token exchange at import time
+    if name == "SPOTIFY_PERMA_TOKEN":
+        return get_spotify_perma_token()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
@@ -1,39 +1,33 @@
-import sys
-from typing import List
+import datetime
+import re
+import time
+from contextlib import contextmanager
+from typing import Dict
 
 import pytz
-from loguru import logger
-from tweepy.models import Status
 
-# Temporary In-memory map to keep track of user replies
-# Will get cleared each new day
-USER_REPLIES = {}
 EASTERN_TZ = pytz.timezone('US/Eastern')
 
-logger.add(sys.stderr, format="<lvl> {level} - {message}</lvl>",
-           filter=f"{__name__}",
-           level="DEBUG",
-           colorize=True,
-           backtrace=True,
-           diagnose=True,
-           catch=True)
+MENTION_PATTERN = re.compile(r"@\w+")
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
 
 
-# noinspection PyBroadException
-def clear_user_reply_map() -> bool:
-    global USER_REPLIES
+def current_day() -> str:
+    """The bot's day (in eastern time) as an ISO date string, e.g. `2022-08-01`"""
+    return datetime.datetime.now(tz=EASTERN_TZ).date().isoformat()
+
+
+def normalize_query(text: str) -> str:
+    """Normalize a song suggestion so that trivially different spellings share a single cache key"""
+    text = MENTION_PATTERN.sub(" ", text.casefold())
+    return NON_WORD_PATTERN.sub(" ", text).strip()
+
+
+@contextmanager
+def timed_phase(name: str, timings: Dict[str, float]):
+    """Record how many seconds the wrapped block took under `name`"""
+    start = time.perf_counter()
     try:
-        USER_REPLIES.clear()
-        return True
-    except Exception:
-        logger.exception(f"Failed to clear reply map")
-        return False
-
-
-def populate_user_replies_map(replies: List[Status]):
-    global USER_REPLIES
-    for reply in replies:
-        if reply.author.id_str not in USER_REPLIES:
-            song = reply.text.strip()
-            logger.debug(f"Previous song suggestion by {reply.author.id_str}: {reply.text}")
-            USER_REPLIES[reply.author.id_str] = song
\ No newline at end of file
+        yield
+    finally:
+        timings[name] = time.perf_counter() - start
\ No newline at end of file
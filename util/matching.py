@@ -0,0 +1,84 @@
+import re
+from difflib import SequenceMatcher
+from typing import List, Set, Tuple
+
+from util import helpers
+
+# Separators people use between song and artist, e.g. `song - artist`, `song — artist` or `song by artist`, tried in order.
+# Spaced symbols come first so titles containing "by" (`Stand by Me - Ben E. King`) and hyphenated names like `Jay-Z` survive,
+# then the word "by", and bare dashes are the last resort
+PROPOSAL_SEPARATOR_PATTERNS = (
+    re.compile(r"\s+[-–—~|:]+\s+"),
+    re.compile(r"\s+by\s+", re.IGNORECASE),
+    re.compile(r"\s*[-–—]+\s*"),
+)
+
+# Below this score the first search is considered a miss and a structured `track: artist:` search is tried
+CONFIDENCE_THRESHOLD = 0.6
+
+TITLE_WEIGHT = 0.55
+ARTIST_WEIGHT = 0.35
+POPULARITY_WEIGHT = 0.10
+
+
+def parse_proposal(proposal: str) -> List[Tuple[str, str]]:
+    """Split a suggestion into (title, artist) candidates. Both orders are returned since people write `artist - song` too"""
+    for pattern in PROPOSAL_SEPARATOR_PATTERNS:
+        parts = [part for part in pattern.split(proposal.strip(), maxsplit=1) if part.strip()]
+        if len(parts) == 2:
+            first, second = (part.strip() for part in parts)
+            return [(first, second), (second, first)]
+    return [(proposal.strip(), "")]
+
+
+def trigrams(text: str) -> Set[str]:
+    padded = f"  {helpers.normalize_query(text)} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def trigram_similarity(a: str, b: str) -> float:
+    a_grams, b_grams = trigrams(a), trigrams(b)
+    if not a_grams or not b_grams:
+        return 0.0
+    return len(a_grams & b_grams) / len(a_grams | b_grams)
+
+
+def token_set_ratio(a: str, b: str) -> float:
+    """Similarity of two strings that ignores word order and duplicated words, between 0 and 1"""
+    a_tokens, b_tokens = set(helpers.normalize_query(a).split()), set(helpers.normalize_query(b).split())
+    if not a_tokens or not b_tokens:
+        return 0.0
+
+    common = " ".join(sorted(a_tokens & b_tokens))
+    a_combined = f"{common} {' '.join(sorted(a_tokens - b_tokens))}".strip()
+    b_combined = f"{common} {' '.join(sorted(b_tokens - a_tokens))}".strip()
+    return max(SequenceMatcher(None, common, a_combined).ratio() if common else 0.0,
+               SequenceMatcher(None, common, b_combined).ratio() if common else 0.0,
+               SequenceMatcher(None, a_combined, b_combined).ratio())
+
+
+def text_similarity(a: str, b: str) -> float:
+    return max(token_set_ratio(a, b), trigram_similarity(a, b))
+
+
+def score_track(title: str, artist: str, track: dict) -> float:
+    title_score = text_similarity(title, track["name"])
+    artist_score = max((text_similarity(artist, track_artist["name"]) for track_artist in track["artists"]), default=0.0) if artist else 0.0
+    popularity_score = track.get("popularity", 0) / 100
+
+    # Without an artist the title has to carry the whole match
+    if not artist:
+        return (TITLE_WEIGHT + ARTIST_WEIGHT) * title_score + POPULARITY_WEIGHT * popularity_score
+    return TITLE_WEIGHT * title_score + ARTIST_WEIGHT * artist_score + POPULARITY_WEIGHT * popularity_score
+
+
+def rank_tracks(proposal: str, tracks: List[dict]) -> List[Tuple[float, dict]]:
+    """Score every search result against every reading of the suggestion, best match first"""
+    candidates = parse_proposal(proposal)
+    ranked = [(max(score_track(title, artist, track) for title, artist in candidates), track) for track in tracks]
+    return sorted(ranked, key=lambda scored: scored[0], reverse=True)
+
+
+def structured_query(proposal: str) -> str:
+    title, artist = parse_proposal(proposal)[0]
+    return f"track:{title} artist:{artist}" if artist else f"track:{title}"
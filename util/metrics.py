@@ -0,0 +1,174 @@
+import re
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, Union
+
+from loguru import logger
+from pymongo import monitoring
+
+# Quantiles reported for every span, computed over the last `reservoir_size` samples
+QUANTILES = (0.5, 0.9, 0.99)
+
+NAME_PATTERN = re.compile(r"[^a-zA-Z0-9_]+")
+
+
+class SpanStats:
+    def __init__(self, reservoir_size: int):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.errors = 0
+        self.samples: Deque[float] = deque(maxlen=reservoir_size)
+
+    def observe(self, seconds: float):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        samples = sorted(self.samples)
+        return samples[min(int(q * len(samples)), len(samples) - 1)] if samples else 0.0
+
+
+class Metrics:
+    """In-process registry of timing spans, counters and gauges, rendered in the Prometheus text format.
+
+    Gauges are callbacks that are only evaluated when the metrics are read. A gauge callback may return a dict,
+    which is exposed as one gauge per key (handy for the `stats()` methods of the bot's components).
+    """
+
+    def __init__(self, prefix: str = "playlistter", reservoir_size: int = 1024):
+        self.prefix = prefix
+        self.reservoir_size = reservoir_size
+        self.started_at = time.time()
+        self._spans: Dict[str, SpanStats] = {}
+        self._counters: Counter = Counter()
+        self._gauges: Dict[str, Callable[[], Union[float, Dict[str, float]]]] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, name: str, amount: int = 1):
+        with self._lock:
+            self._counters[name] += amount
+
+    def gauge(self, name: str, func: Callable[[], Union[float, Dict[str, float]]]):
+        self._gauges[name] = func
+
+    def observe(self, name: str, seconds: float, error: bool = False):
+        with self._lock:
+            span = self._spans.get(name)
+            if span is None:
+                span = self._spans[name] = SpanStats(self.reservoir_size)
+            span.observe(seconds)
+            if error:
+                span.errors += 1
+
+    @contextmanager
+    def span(self, name: str):
+        """Time the wrapped block under `name`. Blocks that raise are still timed, and counted as errors"""
+        start = time.perf_counter()
+        try:
+            yield
+        except BaseException:
+            self.observe(name, time.perf_counter() - start, error=True)
+            raise
+        self.observe(name, time.perf_counter() - start)
+
+    # noinspection PyBroadException
+    def gauges(self) -> Dict[str, float]:
+        values = {}
+        for name, func in list(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                logger.exception(f"Failed to read gauge {name}")
+                continue
+            if isinstance(value, dict):
+                values.update({f"{name}.{key}": sub_value for key, sub_value in value.items()})
+            else:
+                values[name] = value
+        return values
+
+    def summary(self) -> str:
+        """One line per span with count, mean and tail latency, followed by the counters and gauges"""
+        with self._lock:
+            lines = [f"{name}: n={span.count} mean={span.total / span.count * 1000:.1f}ms p90={span.quantile(0.9) * 1000:.1f}ms "
+                     f"p99={span.quantile(0.99) * 1000:.1f}ms max={span.max * 1000:.1f}ms errors={span.errors}"
+                     for name, span in sorted(self._spans.items())]
+            counters = dict(sorted(self._counters.items()))
+        lines.append(f"counters: {counters}")
+        lines.append(f"gauges: {dict(sorted(self.gauges().items()))}")
+        return "\n".join(lines)
+
+    def render(self) -> str:
+        """The registry in the Prometheus text exposition format"""
+        span_metric = f"{self.prefix}_span_seconds"
+        lines = [f"# TYPE {span_metric} summary"]
+        with self._lock:
+            for name, span in sorted(self._spans.items()):
+                for q in QUANTILES:
+                    lines.append(f'{span_metric}{{span="{name}",quantile="{q}"}} {span.quantile(q)}')
+                lines.append(f'{span_metric}_sum{{span="{name}"}} {span.total}')
+                lines.append(f'{span_metric}_count{{span="{name}"}} {span.count}')
+
+            lines.append(f"# TYPE {self.prefix}_span_errors_total counter")
+            lines.extend(f'{self.prefix}_span_errors_total{{span="{name}"}} {span.errors}' for name, span in sorted(self._spans.items()))
+
+            for name, value in sorted(self._counters.items()):
+                lines.append(f"# TYPE {self._metric_name(name)}_total counter")
+                lines.append(f"{self._metric_name(name)}_total {value}")
+
+        for name, value in sorted(self.gauges().items()):
+            lines.append(f"# TYPE {self._metric_name(name)} gauge")
+            lines.append(f"{self._metric_name(name)} {float(value)}")
+
+        lines.append(f"# TYPE {self.prefix}_uptime_seconds gauge")
+        lines.append(f"{self.prefix}_uptime_seconds {time.time() - self.started_at}")
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+        """Serve `/metrics` on a background thread"""
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Scrapes would otherwise be printed to stderr on every request
+                pass
+
+        server = ThreadingHTTPServer((host, port), MetricsHandler)
+        threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+        logger.info(f"Serving metrics on http://{host}:{server.server_port}/metrics")
+        return server
+
+    def _metric_name(self, name: str) -> str:
+        return f"{self.prefix}_{NAME_PATTERN.sub('_', name).strip('_')}"
+
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Times every command sent by a mongo client, e.g. `mongo.find` or `mongo.update`"""
+
+    def __init__(self, metrics: Metrics):
+        self.metrics = metrics
+
+    def started(self, event: monitoring.CommandStartedEvent):
+        pass
+
+    def succeeded(self, event: monitoring.CommandSucceededEvent):
+        self.metrics.observe(f"mongo.{event.command_name}", event.duration_micros / 1e6)
+
+    def failed(self, event: monitoring.CommandFailedEvent):
+        self.metrics.observe(f"mongo.{event.command_name}", event.duration_micros / 1e6, error=True)
@@ -0,0 +1,104 @@
+import threading
+import time
+from typing import Dict, Mapping, Optional, Tuple
+
+from loguru import logger
+
+# Priority lanes. Lower priorities have to leave a share of the bucket untouched for higher ones,
+# so playlist writes still go through when confirmation replies have used up most of the budget
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITY_RESERVES = {PRIORITY_HIGH: 0.0, PRIORITY_NORMAL: 0.1, PRIORITY_LOW: 0.25}
+
+# endpoint -> (requests, per seconds). Twitter limits are the documented per-user/app windows.
+# Spotify doesn't publish its limit (it's a rolling 30 second window per app), so its bucket is a conservative guess
+DEFAULT_LIMITS: Dict[str, Tuple[int, float]] = {
+    "twitter.update_status": (300, 3 * 60 * 60),
+    "twitter.user_timeline": (900, 15 * 60),
+    "twitter.search": (450, 15 * 60),
+    "twitter.verify_credentials": (75, 15 * 60),
+    "twitter.stream_rules": (450, 15 * 60),
+    "spotify": (100, 30),
+}
+
+
+class TokenBucket:
+    def __init__(self, capacity: float, period_seconds: float):
+        self.capacity = capacity
+        self.period_seconds = period_seconds
+        self.refill_per_second = capacity / period_seconds
+        self.tokens = capacity
+        self._updated_at = time.monotonic()
+        self._blocked_until = 0.0
+
+    def try_acquire(self, reserve: float = 0.0) -> float:
+        """Take a token if one is left above `reserve`. Returns 0 on success, otherwise how many seconds to wait before retrying"""
+        now = time.monotonic()
+        if now < self._blocked_until:
+            return self._blocked_until - now
+
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated_at) * self.refill_per_second)
+        self._updated_at = now
+        if self.tokens - 1 >= reserve:
+            self.tokens -= 1
+            return 0.0
+        return (reserve + 1 - self.tokens) / self.refill_per_second
+
+    def update(self, limit: int, remaining: int, reset_epoch: float):
+        """Correct the bucket with what the API says is actually left in the current window"""
+        self.capacity = limit
+        self.refill_per_second = limit / self.period_seconds
+        self.tokens = min(self.tokens, remaining)
+        if remaining <= 0:
+            self._blocked_until = time.monotonic() + max(0.0, reset_epoch - time.time())
+
+
+class RateGovernor:
+    """Shared token buckets for every outbound Twitter and Spotify call, so bursts are smoothed out before the APIs throttle us.
+
+    Buckets start from the documented limits and are corrected from `x-rate-limit-*` response headers whenever they're available.
+    Endpoints without a bucket are never limited.
+    """
+
+    def __init__(self, limits: Optional[Mapping[str, Tuple[int, float]]] = None):
+        self._buckets = {endpoint: TokenBucket(requests, period) for endpoint, (requests, period) in (DEFAULT_LIMITS if limits is None else limits).items()}
+        self._lock = threading.Lock()
+        self.waits: Dict[str, int] = {}
+
+    def acquire(self, endpoint: str, priority: int = PRIORITY_NORMAL, timeout: Optional[float] = None) -> bool:
+        """Block until the endpoint has budget for a call in the given priority lane. Returns False if `timeout` ran out first"""
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            return True
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                wait = bucket.try_acquire(reserve=PRIORITY_RESERVES[priority] * bucket.capacity)
+                if wait:
+                    self.waits[endpoint] = self.waits.get(endpoint, 0) + 1
+            if not wait:
+                return True
+            if deadline is not None and time.monotonic() + wait > deadline:
+                return False
+            logger.debug(f"Rate governor holding {endpoint} call (priority {priority}) for {wait:.2f}s")
+            time.sleep(wait)
+
+    def available(self, endpoint: str) -> float:
+        """Fraction of the endpoint's budget that is currently left"""
+        bucket = self._buckets.get(endpoint)
+        if bucket is None:
+            return 1.0
+        with self._lock:
+            bucket.try_acquire(reserve=bucket.capacity)  # Never succeeds, only refills the bucket
+            return bucket.tokens / bucket.capacity
+
+    def update_from_headers(self, endpoint: str, headers: Optional[Mapping[str, str]]):
+        bucket = self._buckets.get(endpoint)
+        if bucket is None or not headers or "x-rate-limit-remaining" not in headers:
+            return
+        with self._lock:
+            bucket.update(limit=int(headers.get("x-rate-limit-limit", bucket.capacity)),
+                          remaining=int(headers["x-rate-limit-remaining"]),
+                          reset_epoch=float(headers.get("x-rate-limit-reset", 0)))